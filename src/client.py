@@ -18,13 +18,13 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import datetime
+import datetime, time
 
 from PyQt4.QtCore import QTimer
 from twisted.spread import pb
 from twisted.internet import reactor
 from twisted.internet.task import deferLater
-from twisted.internet.defer import Deferred, succeed
+from twisted.internet.defer import Deferred, succeed, maybeDeferred, DeferredList
 from twisted.internet.error import ReactorNotRunning
 from twisted.python.failure import Failure
 from util import logDebug, logException, logWarning, Duration, m18nc, checkMemory
@@ -130,6 +130,7 @@ class Client(object, pb.Referenceable):
         self.table = None
         self.tableList = None
         self.sayable = {} # recompute for each move, use as cache
+        self.lastTraffic = 0.0 # time.time() of the last message from or to the server
 
     def delete(self):
         """for better garbage collection"""
@@ -254,8 +255,11 @@ class Client(object, pb.Referenceable):
                 return Message.NO
         return Message.OK
 
-    def readyForGameStart(self, dummyTableid, gameid, wantedGame, playerNames, shouldSave=True):
-        """the game server asks us if we are ready. A robot is always ready."""
+    def readyForGameStart(self, dummyTableid, gameid, wantedGame, playerNames, shouldSave=True,
+            fastForward=False):
+        """the game server asks us if we are ready. A robot is always ready.
+        fastForward: the server says that no human will answer"""
+        # pylint: disable=R0913
         def disagree(about):
             """do not bother to translate this, it should normally not happen"""
             self.game.close()
@@ -277,6 +281,7 @@ class Client(object, pb.Referenceable):
             self.game = RemoteGame(playerNames, self.table.ruleset,
                 shouldSave=shouldSave, gameid=gameid, wantedGame=wantedGame, client=self,
                 playOpen=self.table.playOpen, autoPlay=self.table.autoPlay)
+        self.game.fastForward = fastForward
         self.game.prepareHand()
         return succeed(Message.OK)
 
@@ -317,7 +322,7 @@ class Client(object, pb.Referenceable):
         delayStep = 0.1
         self._computeSayable(move, answers)
         result = self.intelligence.selectAnswer(answers)
-        if result[0] == Message.Chow:
+        if result[0] == Message.Chow and not self.game.fastForward:
             # self.game.debug('%s waits to see if somebody says Pung or Kong before saying chow' %
             #     self.game.myself.name)
             return deferLater(reactor, delayStep, self.__delayAnswer, result, delay, delayStep)
@@ -344,6 +349,7 @@ class Client(object, pb.Referenceable):
 
     def remote_move(self, playerName, command, *dummyArgs, **kwargs):
         """the server sends us info or a question and always wants us to answer"""
+        self.lastTraffic = time.time()
         if self.game:
             player = self.game.playerByName(playerName)
         elif playerName:
@@ -366,6 +372,37 @@ class Client(object, pb.Referenceable):
         with Duration('Move %s:' % move):
             return self.exec_move(move).addCallback(self.__convertMessage)
 
+    def askServerScore(self, playerName):
+        """we only got a hash of the score string and it does not match.
+        A client talking to a server over the network asks for the string"""
+        pass
+
+    def scoreMatches(self, move):
+        """do we compute the same score for move.player as the server?
+        If we only got a hash of the score string, ask for the string"""
+        if move.notifying or not move.player:
+            return True
+        if move.player.scoreMatchesServer(move.score, move.scoreHash):
+            return True
+        if move.scoreHash:
+            self.askServerScore(move.player.name)
+        return False
+
+    def remote_moves(self, moves):
+        """the server sends several moves at once. They are executed in
+        the same order as if they came one by one. Returns a list with
+        a pair (success, answer) for every move, in the same order. If a
+        move failed, answer is the error message. The other moves are
+        not affected"""
+        return DeferredList(list(maybeDeferred(self.remote_move, playerName, command, **kwargs)
+            for playerName, command, kwargs in moves), consumeErrors=True).addCallback(self.__movesResults)
+
+    @staticmethod
+    def __movesResults(results):
+        """a Failure cannot go over the wire as part of a list"""
+        return list((success, value if success else value.getErrorMessage())
+            for success, value in results)
+
     def exec_move(self, move):
         """mirror the move of a player as told by the the game server"""
         message = move.message
@@ -378,7 +415,7 @@ class Client(object, pb.Referenceable):
             answer = succeed(answer)
         game = self.game
         if game:
-            if not move.notifying and move.player and not move.player.scoreMatchesServer(move.score):
+            if not self.scoreMatches(move):
                 game.close()
             game.moves.append(move)
 # This is an example how to find games where specific situations arise. We prefer games where this
@@ -70,6 +70,7 @@ class Debug(object):
     argString = None
     scores = False
     handCache = False
+    tileCounts = False
     explain = False
     random = False
     deferredBlock = False
@@ -77,6 +78,7 @@ class Debug(object):
     events = ''
     table = False
     gc = False
+    aiProfile = '' # file name for AI decision profiles
 
     def __init__(self):
         raise Exception('Debug is not meant to be instantiated')
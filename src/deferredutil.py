@@ -29,6 +29,7 @@ from util import m18nE, logInfo, logDebug, logException
 from message import Message
 from common import Debug
 from move import Move
+from hand import Hand
 
 class Request(object):
     """holds a Deferred and related attributes, used as part of a DeferredBlock"""
@@ -311,13 +312,13 @@ class DeferredBlock(object):
                 if user.name == player.name:
                     return player
 
-    @staticmethod
-    def __enrichMessage(game, about, command, kwargs):
+    def __enrichMessage(self, game, about, command, kwargs):
         """add supplemental data for debugging"""
         if command.sendScore and about:
             # the clients will compare our status with theirs. This helps
             # very much in finding bugs.
             kwargs['score'] = str(about.hand)
+            self.table.scoreStrings[about.name] = kwargs['score']
         if game and game.gameid and 'token' not in kwargs:
             # this lets the client assert that the message is meant for the current hand
             kwargs['token'] = game.handId()
@@ -349,16 +350,21 @@ class DeferredBlock(object):
         localDeferreds = []
         for rec in self.__convertReceivers(receivers):
             isClient = rec.__class__.__name__.endswith('Client')
+            recKwargs = kwargs
+            if 'score' in kwargs and not isClient and rec.scoreHashes:
+                # the client can do with a hash and ask for the string if needed
+                recKwargs = kwargs.copy()
+                recKwargs['scoreHash'] = Hand.scoreHash(recKwargs.pop('score'))
             if Debug.traffic and not isClient:
                 message = '-> {receiver:<15} about {about} {command}{kwargs}'.format(
                     receiver=rec.name[:15], about=about, command=command,
-                    kwargs=Move.prettyKwargs(kwargs))
+                    kwargs=Move.prettyKwargs(recKwargs))
                 logDebug(message)
             if isClient:
                 defer = Deferred()
-                defer.addCallback(rec.remote_move, command, **kwargs)
+                defer.addCallback(rec.remote_move, command, **recKwargs)
             else:
-                defer = self.table.server.callRemote(rec, 'move', aboutName, command.name, **kwargs)
+                defer = self.table.server.sendMove(rec, aboutName, command.name, **recKwargs)
             if defer:
                 defer.command = command.name
                 defer.notifying = 'notifying' in kwargs
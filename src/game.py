@@ -20,21 +20,21 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import datetime
 import weakref
+from itertools import count
 from random import Random
-from collections import defaultdict
 from twisted.internet.defer import succeed
 from util import logError, logWarning, logException, logDebug, m18n, stack
-from common import WINDS, Internal, elements, IntDict, Debug, isAlive
+from common import WINDS, Internal, Debug, isAlive
 from query import Transaction, Query
 from rule import Ruleset
-from tile import Tile
+from tile import Tile, TileCounter, TILEIDS
 from meld import tileKey
 from hand import Hand
 from sound import Voice
 from wall import Wall
 from move import Move
 from animation import Animated
-from player import Player, Players
+from player import Player, Players, Danger
 
 class CountingRandom(Random):
     """counts how often random() is called and prints debug info"""
@@ -92,6 +92,8 @@ class Game(object):
     # pylint: disable=R0902
     # pylint we need more than 10 instance attributes
 
+    serials = count(1)
+
     def __del__(self):
         """break reference cycles"""
         self.clearHand()
@@ -117,6 +119,7 @@ class Game(object):
         # pylint: disable=R0915
         # pylint we need more than 50 statements
         self.players = Players() # if we fail later on in init, at least we can still close the program
+        self.serial = next(Game.serials) # never reused, unlike id(self). Partitions Hand.cache
         self._client = None
         self.client = client
         self.rotated = 0
@@ -148,9 +151,9 @@ class Game(object):
         self.handDiscardCount = 0
         self.divideAt = None
         self.lastDiscard = None # always uppercase
-        self.visibleTiles = IntDict()
-        self.discardedTiles = IntDict(self.visibleTiles) # tile names are always lowercase
-        self.dangerousTiles = list()
+        self.visibleTiles = TileCounter() # discarded and exposed tiles of all players
+        self.discardedTiles = TileCounter(self.visibleTiles) # tile names are always lowercase
+        self.shortWall = False # the end of the living wall is reached
         self.csvTags = []
         self._setGameId()
         self.__useRuleset(ruleset)
@@ -235,6 +238,18 @@ class Game(object):
         if forAllPlayers or self.belongsToHumanPlayer():
             self.csvTags.append('%s/%s' % (tag, self.handId()))
 
+    def csvRow(self, aiVariant):
+        """the result of a finished game as a row for the csv file used by kajonggtest.
+        aiVariant is written as given on the command line, kajonggtest compares it"""
+        gameWinner = max(self.players, key=lambda x: x.balance)
+        row = [aiVariant, str(self.seed), ','.join(self.csvTags)]
+        for player in sorted(self.players, key=lambda x: x.name):
+            row.append(player.name.encode('utf-8'))
+            row.append(player.balance)
+            row.append(player.wonCount)
+            row.append(1 if player == gameWinner else 0)
+        return row
+
     def isFirstHand(self):
         """as the name says"""
         return self.roundHandCount == 0 and self.roundsFinished == 0
@@ -544,9 +559,11 @@ class Game(object):
         self.__activePlayer = None
         self.prevActivePlayer = None
         Hand.clearCache(self)
-        self.dangerousTiles = list()
+        self.shortWall = False # the end of the living wall is reached
         self.discardedTiles.clear()
         assert self.visibleTiles.count() == 0
+        if Debug.tileCounts:
+            assert not any(self.visibleTiles.counts), self.visibleTiles.counts
 
     def prepareHand(self):
         """prepares the next hand"""
@@ -563,9 +580,11 @@ class Game(object):
     def initHand(self):
         """directly before starting"""
         Hand.clearCache(self)
-        self.dangerousTiles = list()
+        self.shortWall = False # the end of the living wall is reached
         self.discardedTiles.clear()
         assert self.visibleTiles.count() == 0
+        if Debug.tileCounts:
+            assert not any(self.visibleTiles.counts), self.visibleTiles.counts
         if Internal.field:
             Internal.field.prepareHand()
         self.__setHandSeed()
@@ -823,26 +842,31 @@ class Game(object):
             self.divideAt -= 1
         self.divideAt %= len(self.wall.tiles)
 
+    def isDangerousFor(self, forPlayer, tile):
+        """True if discarding tile would be Dangerous game for forPlayer"""
+        if isinstance(tile, Tile):
+            tile = tile.element
+        tileIdx = TILEIDS[tile]
+        if self.shortWall and not self.visibleTiles.counts[tileIdx]:
+            return True
+        return any(x.dangerousMask[tileIdx] for x in forPlayer.others())
+
     def dangerousFor(self, forPlayer, tile):
         """returns a list of explaining texts if discarding tile
         would be Dangerous game for forPlayer. One text for each
         reason - there might be more than one"""
         if isinstance(tile, Tile):
             tile = tile.element
-        tile = tile.lower()
+        tileIdx = TILEIDS[tile]
         result = []
-        for dang, txt in self.dangerousTiles:
-            if tile in dang:
-                result.append(txt)
+        if self.shortWall and not self.visibleTiles.counts[tileIdx]:
+            result.append(m18n('Short living wall: Tile is invisible, hence dangerous'))
         for player in forPlayer.others():
-            for dang, txt in player.dangerousTiles:
-                if tile in dang:
-                    result.append(txt)
+            result.extend(Danger.texts(player.dangerousMask[tileIdx], player.localName))
         return result
 
     def computeDangerous(self, playerChanged=None):
         """recompute gamewide dangerous tiles. Either for playerChanged or for all players"""
-        self.dangerousTiles = list()
         if playerChanged:
             playerChanged.findDangerousTiles()
         else:
@@ -851,14 +875,10 @@ class Game(object):
         self._endWallDangerous()
 
     def _endWallDangerous(self):
-        """if end of living wall is reached, declare all invisible tiles as dangerous"""
+        """if end of living wall is reached, declare all invisible tiles as dangerous.
+        Which tiles are invisible is looked up in visibleTiles when needed"""
         if len(self.wall.living) <=5:
-            allTiles = [x for x in defaultdict.keys(elements.occurrence) if x[0] not in 'fy']
-            # see http://www.logilab.org/ticket/23986
-            invisibleTiles = set(x for x in allTiles if x not in self.visibleTiles)
-            msg = m18n('Short living wall: Tile is invisible, hence dangerous')
-            self.dangerousTiles = list(x for x in self.dangerousTiles if x[1] != msg)
-            self.dangerousTiles.append((invisibleTiles, msg))
+            self.shortWall = True
 
     def appendMove(self, player, command, kwargs):
         """append a Move object to self.moves"""
@@ -916,6 +936,7 @@ class RemoteGame(PlayingGame):
             wantedGame=wantedGame, shouldSave=shouldSave, client=client)
         self.playOpen = playOpen
         self.autoPlay = autoPlay
+        self.fastForward = False # only robots: nobody needs to wait for slow humans
         myself = self.myself
         if self.belongsToHumanPlayer() and myself:
             myself.voice = Voice.locate(myself.name)
@@ -1005,10 +1026,7 @@ class RemoteGame(PlayingGame):
         else:
             self.lastDiscard = Tile(tileName)
         player.remove(tile=self.lastDiscard)
-        if any(tileName.lower() in x[0] for x in self.dangerousTiles):
-            self.computeDangerous()
-        else:
-            self._endWallDangerous()
+        self._endWallDangerous()
         self.handDiscardCount += 1
         if Internal.field:
             for tile in player.handBoard.tiles:
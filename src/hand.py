@@ -21,8 +21,14 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 Read the user manual for a description of the interface to this scoring engine
 """
 
+import threading
+from copy import copy
+from collections import OrderedDict
+from hashlib import md5 # pylint: disable=E0611
+
 from util import logDebug
-from meld import Meld, meldKey, meldsContent, Pairs, CONCEALED
+from meld import Meld, meldKey, meldsContent, Pairs, CONCEALED, SuitDecomposer
+from tile import tileCounts, tileName, TILEIDS, BONUSBASE
 from rule import Score, Ruleset
 from common import elements, Debug
 
@@ -42,47 +48,158 @@ class UsedRule(object):
     def __repr__(self):
         return 'UsedRule(%s)' % str(self)
 
+class HandCache(object):
+    """a size limited cache for Hand instances with LRU eviction.
+    Every game gets its own partition, so one busy table cannot
+    push the working set of another table out of the cache. Hands
+    evaluated with only a Ruleset are partitioned by Ruleset.scoringKey"""
+
+    maxEntries = 5000 # per partition
+
+    def __init__(self):
+        self.partitions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return sum(len(x) for x in self.partitions.values())
+
+    def get(self, partitionKey, key):
+        """returns the cached value or raises KeyError. Counts hits and misses"""
+        partition = self.partitions.get(partitionKey)
+        if partition is None or key not in partition:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        result = partition.pop(key)
+        partition[key] = result # now it is the most recently used entry
+        return result
+
+    def put(self, partitionKey, key, value):
+        """store value, evicting the least recently used entries if needed"""
+        partition = self.partitions.get(partitionKey)
+        if partition is None:
+            partition = self.partitions[partitionKey] = OrderedDict()
+        elif key in partition:
+            del partition[key]
+        partition[key] = value
+        while len(partition) > self.maxEntries:
+            partition.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self, partitionKey=None):
+        """clear one partition or all of them"""
+        if partitionKey is None:
+            self.partitions.clear()
+        elif partitionKey in self.partitions:
+            del self.partitions[partitionKey]
+
+    def resetStatistics(self):
+        """start counting from zero"""
+        self.hits = self.misses = self.evictions = 0
+
+    def statistics(self):
+        """a dict with the counters, meant for sizing the cache"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+            entries=len(self), partitions=len(self.partitions))
+
+    def __str__(self):
+        return 'cache hits:%(hits)d misses:%(misses)d evictions:%(evictions)d ' \
+            'entries:%(entries)d partitions:%(partitions)d' % self.statistics()
+
 class Hand(object):
     """represent the hand to be evaluated"""
 
     # pylint: disable=R0902
     # pylint we need more than 10 instance attributes
 
-    cache = dict()
-    misses = 0
-    hits = 0
+    cache = HandCache()
+    building = threading.local() # keys of the Hands under construction, for finding recursions
+    lock = threading.Lock() # the server also evaluates hands in threads
+    created = 0 # counts all Hand instances, for profiling
 
     @staticmethod
     def clearCache(game):
-        """clears the cache with Hands"""
-        if Debug.handCache and Hand.cache:
-            game.debug('cache hits:%d misses:%d' % (Hand.hits, Hand.misses))
-        Hand.cache.clear()
-        Hand.hits = 0
-        Hand.misses = 0
+        """clears the cached Hands of game"""
+        if Debug.handCache and len(Hand.cache):
+            game.debug(str(Hand.cache))
+        with Hand.lock:
+            Hand.cache.clear(game.serial)
+
+    @staticmethod
+    def cacheKey(ruleset, string, computedRules=None, robbedTile=None):
+        """returns the cache partition and a canonical key for the evaluation
+        of string: the scoring key of the ruleset and a tuple with the sorted melds,
+        the mj string, the robbed tile, the names of the computed rules and the owning player.
+        Evaluations using only a Ruleset do not depend on any object identity,
+        so they may be shared between tables, games and processes.
+        Evaluations for a player may look at the game state, so they also
+        get the serial number of the player and go into the partition of the game"""
+        if isinstance(ruleset, Hand):
+            owner = ruleset.player
+            rulesetKey = ruleset.ruleset.scoringKey
+        elif isinstance(ruleset, Ruleset):
+            owner = None
+            rulesetKey = ruleset.scoringKey
+        else:
+            owner = ruleset
+            rulesetKey = ruleset.game.ruleset.scoringKey
+        tileParts = []
+        mjParts = []
+        for part in string.split():
+            if part[0] in 'MmxL':
+                mjParts.append(part)
+            else:
+                tileParts.append(part)
+        cRuleNames = tuple(rule.name for rule in computedRules) if computedRules else ()
+        key = (rulesetKey, ' '.join(sorted(tileParts)), ' '.join(mjParts),
+            robbedTile, cRuleNames, owner.serial if owner else None)
+        return owner.game.serial if owner else rulesetKey, key
+
+    @staticmethod
+    def scoreHash(score):
+        """a short replacement for the score string of a hand, for
+        comparing server and client"""
+        return md5(score).hexdigest()[:16]
 
     @staticmethod
     def cached(ruleset, string, computedRules=None, robbedTile=None):
         """since a Hand instance is never changed, we can use a cache"""
         if computedRules is not None and not isinstance(computedRules, list):
             computedRules = list([computedRules])
-        cRuleHash = '&&'.join([rule.name for rule in computedRules]) if computedRules else 'None'
-        if isinstance(ruleset, Hand):
-            cacheId = id(ruleset.player or ruleset.ruleset)
-        else:
-            cacheId = id(ruleset)
-        cacheKey = hash((cacheId, string, robbedTile, cRuleHash))
+        partitionKey, cacheKey = Hand.cacheKey(ruleset, string, computedRules, robbedTile)
         cache = Hand.cache
-        if cacheKey in cache:
-            if cache[cacheKey] is None:
-                raise Exception('recursion: Hand calls itself for same content')
-            Hand.hits += 1
-            return cache[cacheKey]
-        Hand.misses += 1
-        cache[cacheKey] = None
-        result = Hand(ruleset, string,
-            computedRules=computedRules, robbedTile=robbedTile)
-        cache[cacheKey] = result
+        with Hand.lock:
+            try:
+                return cache.get(partitionKey, cacheKey).withString(string)
+            except KeyError:
+                pass
+        # build outside of the lock, other threads may need the cache meanwhile.
+        # If two threads build the same Hand, both results are equal
+        building = Hand.building.__dict__.setdefault('keys', set())
+        if cacheKey in building:
+            raise Exception('recursion: Hand calls itself for same content')
+        building.add(cacheKey)
+        try:
+            result = Hand(ruleset, string,
+                computedRules=computedRules, robbedTile=robbedTile)
+        finally:
+            building.discard(cacheKey)
+        with Hand.lock:
+            cache.put(partitionKey, cacheKey, result)
+        return result
+
+    def withString(self, string):
+        """returns a Hand for string with the evaluation of this one. The cache
+        key does not depend on the order of the melds but callers may look at
+        the parts of Hand.string, so string must keep the order they asked for"""
+        if not self.won:
+            string = string.replace(' M', ' m')
+        if string == self.string:
+            return self
+        result = copy(self)
+        result.string = string
         return result
 
     def __init__(self, ruleset, string, computedRules=None, robbedTile=None):
@@ -90,6 +207,7 @@ class Hand(object):
         ruleset can be Hand, Game or Ruleset."""
         # silence pylint. This method is time critical, so do not split it into smaller methods
         # pylint: disable=R0902,R0914,R0912,R0915
+        Hand.created += 1
         if isinstance(ruleset, Hand):
             self.ruleset = ruleset.ruleset
             self.player = ruleset.player
@@ -135,6 +253,7 @@ class Hand(object):
         self.__lastTile = self.__lastSource = self.__announcements = ''
         self.__lastMeld = 0
         self.__lastMelds = []
+        self.__tilesToWin = None
         self.hiddenMelds = []
         self.declaredMelds = []
         self.melds = []
@@ -142,6 +261,7 @@ class Hand(object):
         self.bonusMelds, tileString = self.__separateBonusMelds(tileString)
         self.tileNames = Pairs(tileString.replace(' ','').replace('R', ''))
         self.tileNames.sort()
+        self.counts = tileCounts(self.tileNames)
         self.values = ''.join(x[1] for x in self.tileNames)
         self.suits = set(x[0].lower() for x in self.tileNames)
         self.lenOffset = self.__computeLenOffset(tileString)
@@ -300,8 +420,7 @@ class Hand(object):
             assert self.__lastTile in self.tileNames, 'lastTile %s is not in tiles %s, mjStr=%s' % (
                 self.__lastTile, ' '.join(self.tileNames), self.mjStr)
             if self.__lastSource == 'k':
-                assert self.tileNames.count(self.__lastTile.lower()) + \
-                    self.tileNames.count(self.__lastTile.capitalize()) == 1, \
+                assert self.counts[TILEIDS[self.__lastTile]] == 1, \
                     'Robbing kong: I cannot have lastTile %s more than once in %s' % (
                     self.__lastTile, ' '.join(self.tileNames))
 
@@ -441,6 +560,34 @@ class Hand(object):
                 break
         return result
 
+    def tilesToWin(self):
+        """for every mjRule knowing missingTiles: a tuple with the number of
+        tiles missing for mah jongg and the set of tiles reducing that number.
+        0 means mah jongg, 1 means calling. This only looks at tile counts,
+        it does not build any Hand, so scoring limits are not checked"""
+        if self.__tilesToWin is None:
+            result = {}
+            if 'Xy' not in self.tileNamesInHand:
+                counts = tileCounts(self.tileNamesInHand)
+                for mjRule in self.ruleset.mjRules:
+                    func = mjRule.function
+                    if not hasattr(func, 'missingTiles'):
+                        continue
+                    missing = func.missingTiles(self, counts)
+                    if missing is None:
+                        continue
+                    better = set()
+                    if self.lenOffset < 1:
+                        for tileIdx in range(BONUSBASE):
+                            if self.counts[tileIdx] < 4:
+                                counts[tileIdx] += 1
+                                if func.missingTiles(self, counts) < missing:
+                                    better.add(tileName(tileIdx))
+                                counts[tileIdx] -= 1
+                    result[mjRule] = (missing, better)
+            self.__tilesToWin = result
+        return self.__tilesToWin
+
     def __maybeMahjongg(self):
         """check if this is a mah jongg hand.
         Return a sorted list of matching MJ rules, highest
@@ -449,7 +596,8 @@ class Hand(object):
             return []
         if self.lenOffset != 1:
             return []
-        matchingMJRules = [x for x in self.ruleset.mjRules if x.appliesToHand(self)]
+        matchingMJRules = [x for x in self.ruleset.candidateRules(self.ruleset.mjRules, self.suits)
+            if x.appliesToHand(self)]
         if self.robbedTile and self.robbedTile.istitle():
             # Millington 58: robbing hidden kong is only allowed for 13 orphans
             matchingMJRules = [x for x in matchingMJRules if 'mayrobhiddenkong' in x.options]
@@ -472,42 +620,16 @@ class Hand(object):
             assert Meld(splits[0]).isValid()   # or the splitRules are wrong
         return melds
 
-    def __recurse(self, cVariants, foundMelds, rest, maxPairs, color):
-        """build the variants recursively"""
-        melds = []
-        for value in set(rest):
-            intValue = int(value)
-            if rest.count(value) == 3:
-                melds.append([value] * 3)
-            elif rest.count(value) == 2:
-                melds.append([value] * 2)
-            if rest.count(str(intValue + 1)) and rest.count(str(intValue + 2)):
-                melds.append([value, str(intValue+1), str(intValue+2)])
-        pairsFound = sum(len(x) == 2 for x in foundMelds)
-        for meld in (m for m in melds if len(m) !=2 or pairsFound < maxPairs):
-            restCopy = rest[:]
-            for value in meld:
-                restCopy.remove(value)
-            newMelds = foundMelds[:]
-            newMelds.append(meld)
-            if restCopy:
-                self.__recurse(cVariants, newMelds, restCopy, maxPairs, color)
-            else:
-                for idx, newMeld in enumerate(newMelds):
-                    newMelds[idx] = ''.join(color+x for x in newMeld)
-                cVariants.append(' '.join(sorted(newMelds )))
-
     def genVariants(self, original0, maxPairs=1):
-        """generates all possible meld variants out of original
-        where original is a list of tile values like ['1','1','2']"""
+        """generates all possible meld variants out of original0
+        where original0 is a list of tile names of one color like ['S1','S1','S2']"""
         color = original0[0][0]
-        original = [x[1] for x in original0]
-        cVariants = []
-        self.__recurse(cVariants, [], original, maxPairs, color)
+        counts = [0] * 9
+        for tileName in original0:
+            counts[int(tileName[1]) - 1] += 1
         gVariants = []
-        for cVariant in set(cVariants):
-            melds = [Meld(x) for x in cVariant.split()]
-            gVariants.append(melds)
+        for variant in SuitDecomposer.variants(tuple(counts), maxPairs):
+            gVariants.append([Meld(''.join(color + str(x) for x in meld)) for meld in variant])
         if not gVariants:
             gVariants.append(self.splitRegex(original0)) # fallback: nothing useful found
         return gVariants
@@ -573,18 +695,31 @@ class Hand(object):
 
     def __matchingRules(self, rules):
         """return all matching rules for this hand"""
-        return list(rule for rule in rules if rule.appliesToHand(self))
+        return list(rule for rule in self.ruleset.candidateRules(rules, self.suits)
+            if rule.appliesToHand(self))
 
     def __applyMeldRules(self):
-        """apply all rules for single melds"""
-        for rule in self.ruleset.meldRules:
-            for meld in self.melds + self.bonusMelds:
-                if rule.appliesToMeld(self, meld):
+        """apply all rules for single melds. Which of them apply only depends
+        on the meld and on the winds, so the ruleset remembers that for all
+        hands: after picking or discarding a tile, only melds we did not
+        see before are checked"""
+        memo = self.ruleset.meldRuleMemo
+        meldRules = self.ruleset.meldRules
+        melds = self.melds + self.bonusMelds
+        applying = []
+        for meld in melds:
+            key = (meld.joined, self.ownWind, self.roundWind)
+            if key not in memo:
+                memo[key] = tuple(rule.appliesToMeld(self, meld) for rule in meldRules)
+            applying.append(memo[key])
+        for idx, rule in enumerate(meldRules):
+            for meld, applies in zip(melds, applying):
+                if applies[idx]:
                     self.usedRules.append(UsedRule(rule, meld))
 
     def __applyHandRules(self):
         """apply all hand rules for both winners and losers"""
-        for rule in self.ruleset.handRules:
+        for rule in self.ruleset.candidateRules(self.ruleset.handRules, self.suits):
             if rule.appliesToHand(self):
                 self.usedRules.append(UsedRule(rule))
 
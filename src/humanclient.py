@@ -18,7 +18,7 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import csv, resource, random
+import csv, resource, random, time
 
 from twisted.spread import pb
 from twisted.python.failure import Failure
@@ -42,8 +42,7 @@ from client import Client, ClientTable
 from meld import Meld
 from tables import TableList, SelectRuleset
 from sound import Voice
-import intelligence
-import altint
+from intelligence import findAI
 from login import Connection
 from rule import Ruleset
 
@@ -356,7 +355,7 @@ class HumanClient(Client):
     # pylint: disable=R0904
     humanClients = []
     def __init__(self):
-        aiClass = self.__findAI([intelligence, altint], Options.AI)
+        aiClass = findAI(Options.AI)
         if not aiClass:
             raise Exception('intelligence %s is undefined' % Options.AI)
         Client.__init__(self, intelligence=aiClass)
@@ -411,8 +410,15 @@ class HumanClient(Client):
             Internal.dbIdent,
             voiceId, maxGameId, Internal.version).addCallbacks(self.__initTableList, self.__versionError)
 
+    @staticmethod
+    def __olderServer(dummyFailure):
+        """older servers do not know this"""
+        pass
+
     def __initTableList(self, dummy):
         """first load of the list. Process options like --demo, --table, --join"""
+        self.callServer('batchMoves').addErrback(self.__olderServer)
+        self.callServer('scoreHashes').addErrback(self.__olderServer)
         self.showTableList()
         if SingleshotOptions.table:
             Internal.autoPlay = False
@@ -438,14 +444,6 @@ class HumanClient(Client):
         """as the name says"""
         Internal.field.startingGame = False
 
-    @staticmethod
-    def __findAI(modules, aiName):
-        """list of all alternative AIs defined in altint.py"""
-        for modul in modules:
-            for key, value in modul.__dict__.items():
-                if key == 'AI' + aiName:
-                    return value
-
     def isRobotClient(self):
         """avoid using isinstance, it would import too much for kajonggserver"""
         return False
@@ -559,14 +557,17 @@ class HumanClient(Client):
         if table.chatWindow:
             table.chatWindow.receiveLine(chatLine)
 
-    def readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave=True):
+    def readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave=True,
+            fastForward=False):
         """playerNames are in wind order ESWN"""
+        # pylint: disable=R0913
         def answered(result):
             """callback, called after the client player said yes or no"""
             self.beginQuestion = None
             if self.connection and result:
                 # still connected and yes, we are
-                Client.readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave)
+                Client.readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave,
+                    fastForward)
                 return Message.OK
             else:
                 return Message.NoGameStart
@@ -583,7 +584,8 @@ class HumanClient(Client):
             return Message.NoGameStart
         if sum(not x[1].startswith('Robot ') for x in playerNames) == 1:
             # we play against 3 robots and we already told the server to start: no need to ask again
-            return Client.readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave)
+            return Client.readyForGameStart(self, tableid, gameid, wantedGame, playerNames, shouldSave,
+                fastForward)
         assert not self.table
         assert self.tables
         self.table = self._tableById(tableid)
@@ -713,17 +715,10 @@ class HumanClient(Client):
             if self.game:
                 self.game.rotateWinds()
                 if Options.csv:
-                    gameWinner = max(self.game.players, key=lambda x: x.balance)
                     writer = csv.writer(open(Options.csv,'a'), delimiter=';')
                     if Debug.process:
                         self.game.csvTags.append('MEM:%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-                    row = [Options.AI, str(self.game.seed), ','.join(self.game.csvTags)]
-                    for player in sorted(self.game.players, key=lambda x: x.name):
-                        row.append(player.name.encode('utf-8'))
-                        row.append(player.balance)
-                        row.append(player.wonCount)
-                        row.append(1 if player == gameWinner else 0)
-                    writer.writerow(row)
+                    writer.writerow(self.game.csvRow(Options.AI))
                     del writer
                 if self.game.autoPlay and Internal.field:
                     Internal.field.close()
@@ -837,6 +832,7 @@ class HumanClient(Client):
         if self.connection:
             if args[0] is None:
                 args = args[1:]
+            self.lastTraffic = time.time()
             try:
                 if Debug.traffic:
                     if self.game:
@@ -857,6 +853,16 @@ class HumanClient(Client):
         else:
             return succeed(None)
 
+    def askServerScore(self, playerName):
+        """log the score string of the server for debugging"""
+        def gotScore(score):
+            """the server might have forgotten it"""
+            logDebug('%s serverScore:%s' % (playerName, score))
+        def noScore(failure):
+            """an older server or we are not at that table anymore"""
+            logDebug('%s serverScore not available: %s' % (playerName, failure.getErrorMessage()))
+        self.callServer('scoreString', self.table.tableid, playerName).addCallbacks(gotScore, noScore)
+
     def sendChat(self, chatLine):
         """send chat message to server"""
         return self.callServer('chat', chatLine.asList())
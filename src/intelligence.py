@@ -18,9 +18,19 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
+import os
+import sys
+import imp
+import json
+import time
+from collections import OrderedDict
+
 from message import Message
 from common import IntDict, Debug
+from util import appdataDir, logWarning
+from hand import Hand
 from meld import elementKey
+from tile import tileName, TILEIDS, BONUSBASE
 
 class AIDefault(object):
     """all AI code should go in here"""
@@ -33,6 +43,14 @@ class AIDefault(object):
 
     def __init__(self, client):
         self.client = client
+        self.candidates = DiscardCandidates()
+        AIRegistry.warmUp(self.__class__)
+
+    @classmethod
+    def warmUp(cls):
+        """called once per process before the first instance of cls is made.
+        Override this to precompute tables shared by all instances"""
+        pass
 
     def name(self):
         """return our name"""
@@ -64,9 +82,9 @@ class AIDefault(object):
         Much of this is just trial and success - trying to get as much AI
         as possible with limited computing resources, it stands on
         no theoretical basis"""
-        candidates = DiscardCandidates(self.client.game, hand)
+        candidates = self.candidates.prepare(self.client.game, hand)
         result = self.weighDiscardCandidates(candidates).best()
-        candidates.unlink()
+        candidates.release()
         return result
 
     def weighDiscardCandidates(self, candidates):
@@ -82,14 +100,20 @@ class AIDefault(object):
                 aiFilter = aiFilter.weigh
             else:
                 filterName = aiFilter.__name__
-            if Debug.robotAI:
+            profile = candidates.profile
+            if Debug.robotAI or profile:
                 prevWeights = list((x.name, x.keep) for x in candidates)
+                if profile:
+                    profile.startFilter()
                 candidates = aiFilter(self, candidates)
-                newWeights = list((x.name, x.keep) for x in candidates)
-                for oldW, newW in zip(prevWeights, newWeights):
-                    if oldW != newW:
-                        game.debug('%s: %s: %.3f->%.3f' % (
-                            filterName, oldW[0], oldW[1], newW[1]))
+                if profile:
+                    profile.endFilter(filterName, prevWeights, candidates)
+                if Debug.robotAI:
+                    newWeights = list((x.name, x.keep) for x in candidates)
+                    for oldW, newW in zip(prevWeights, newWeights):
+                        if oldW != newW:
+                            game.debug('%s: %s: %.3f->%.3f' % (
+                                filterName, oldW[0], oldW[1], newW[1]))
             else:
                 candidates = aiFilter(self, candidates)
         return candidates
@@ -320,28 +344,59 @@ class AIDefault(object):
         return result
 
 class TileAI(object):
-    """holds a few AI related tile properties"""
+    """holds a few AI related tile properties. DiscardCandidates holds
+    one TileAI for every tile id and reuses it for all decisions"""
     # pylint: disable=R0902
     # we do want that many instance attributes
-    def __init__(self, candidates, name):
-        self.name = name
-        self.group, self.value = name[:2]
-        if self.value in '123456789bgreswn' and len(name) == 2:
-            self.occurrence = candidates.hiddenTiles.count(name)
-            self.available = candidates.game.myself.tileAvailable(name, candidates.hand)
-            self.maxPossible = self.available + self.occurrence
-            self.dangerous = bool(candidates.game.dangerousFor(candidates.game.myself, name))
+    __slots__ = ('candidates', 'tileIdx', 'name', 'group', 'value', 'occurrence',
+        'available', 'maxPossible', 'dangerous', 'keep', 'decision')
+
+    def __init__(self, candidates, tileIdx=None):
+        self.candidates = candidates
+        self.tileIdx = tileIdx
+        if tileIdx is None:
+            # stands for all suit values below 1 and above 9
+            self.name = self.group = self.value = ''
         else:
-            # value might be -1, 0, 10, 11 for suits
-            self.occurrence = 0
-            self.available = 0
-            self.maxPossible = 0
-            self.dangerous = False
+            self.name = tileName(tileIdx)
+            self.group, self.value = self.name
+        self.occurrence = 0
+        self.available = 0
+        self.maxPossible = 0
+        self.dangerous = False
+        self.keep = 0.0
+        self.decision = None
+
+    def reset(self, decision):
+        """compute the properties for a new decision"""
+        candidates = self.candidates
+        myself = candidates.game.myself
+        self.decision = decision
+        self.occurrence = candidates.hiddenTiles.count(self.name)
+        self.available = myself.tileAvailable(self.name, candidates.hand)
+        self.maxPossible = self.available + self.occurrence
+        self.dangerous = candidates.game.isDangerousFor(myself, self.name)
         self.keep = 0.0
-        self.prev = None
-        self.next = None
-        self.prev2 = None
-        self.next2 = None
+
+    @property
+    def prev(self):
+        """the tile with the next lower value, None for honors"""
+        return self.candidates.neighbour(self, -1)
+
+    @property
+    def prev2(self):
+        """the tile with value - 2, None for honors"""
+        return self.candidates.neighbour(self, -2)
+
+    @property
+    def next(self):
+        """the tile with the next higher value, None for honors"""
+        return self.candidates.neighbour(self, 1)
+
+    @property
+    def next2(self):
+        """the tile with value + 2, None for honors"""
+        return self.candidates.neighbour(self, 2)
 
     def __str__(self):
         dang = ' dang:%d' % self.dangerous if self.dangerous else ''
@@ -349,61 +404,60 @@ class TileAI(object):
 
 class DiscardCandidates(list):
     """a list of TileAI objects. This class should only hold
-    AI neutral methods"""
-    def __init__(self, game, hand):
+    AI neutral methods. Every robot has one instance, prepare()
+    fills it for the next decision"""
+    def __init__(self):
         list.__init__(self)
+        self.game = None
+        self.hand = None
+        self.hiddenTiles = []
+        self.groupCounts = IntDict() # counts for tile groups (sbcdw), exposed and concealed
+        self.declaredGroupCounts = IntDict()
+        self.decision = 0
+        self.profile = None
+        self.slots = list(TileAI(self, x) for x in range(BONUSBASE))
+        self.nothing = TileAI(self)
+
+    def prepare(self, game, hand):
+        """the candidates for discarding from hand"""
+        del self[:]
+        self.decision += 1
         self.game = game
         self.hand = hand
+        self.profile = AIProfile(game) if Debug.aiProfile else None
         self.hiddenTiles = list(x.lower() for x in hand.tileNamesInHand)
-        self.groupCounts = IntDict() # counts for tile groups (sbcdw), exposed and concealed
+        self.groupCounts.clear()
         for tile in self.hiddenTiles:
             self.groupCounts[tile[0]] += 1
-        self.declaredGroupCounts = IntDict()
+        self.declaredGroupCounts.clear()
         for tile in sum((x.pairs.lower() for x in hand.declaredMelds), []):
             self.groupCounts[tile[0]] += 1
             self.declaredGroupCounts[tile[0]] += 1
-        self.extend(list(TileAI(self, x) for x in sorted(set(self.hiddenTiles), key=elementKey)))
-        self.link()
-
-    def link(self):
-        """define values for candidate.prev and candidate.next"""
-        prev = prev2 = None
-        for this in self:
-            if this.group in 'sbc':
-                thisValue = this.value
-                if prev and prev.group == this.group:
-                    if int(prev.value) + 1 == int(thisValue):
-                        prev.next = this
-                        this.prev = prev
-                    if int(prev.value) + 2 == int(thisValue):
-                        prev.next2 = this
-                        this.prev2 = prev
-                if prev2 and prev2.group == this.group and int(prev2.value) + 2 == int(thisValue):
-                    prev2.next2 = this
-                    this.prev2 = prev2
-            prev2 = prev
-            prev = this
-        for this in self:
-            if this.group in 'sbc':
-                # we want every tile to have prev/prev2/next/next2
-                # the names do not matter, just occurrence, available etc
-                thisValue = this.value
-                if not this.prev:
-                    this.prev = TileAI(self, this.group +  str(int(thisValue)-1))
-                if not this.prev2:
-                    this.prev2 = TileAI(self, this.group +  str(int(thisValue)-2))
-                if not this.next:
-                    this.next = TileAI(self, this.group +  str(int(thisValue)+1))
-                if not this.next2:
-                    this.next2 = TileAI(self, this.group +  str(int(thisValue)+2))
-
-    def unlink(self):
-        """remove links between elements. This helps garbage collection."""
-        for this in self:
-            this.prev = None
-            this.next = None
-            this.prev2 = None
-            this.next2 = None
+        self.extend(list(self.slot(TILEIDS[x]) for x in sorted(set(self.hiddenTiles), key=elementKey)))
+        return self
+
+    def release(self):
+        """forget game and hand until the next decision"""
+        del self[:]
+        self.game = None
+        self.hand = None
+        self.profile = None
+
+    def slot(self, tileIdx):
+        """the TileAI for tileIdx, computed for this decision"""
+        result = self.slots[tileIdx]
+        if result.decision != self.decision:
+            result.reset(self.decision)
+        return result
+
+    def neighbour(self, tile, offset):
+        """the TileAI of the same suit with value + offset. Beyond
+        the suit, a TileAI where everything is 0"""
+        if not tile.group or tile.group not in 'sbc':
+            return None
+        if not 1 <= int(tile.value) + offset <= 9:
+            return self.nothing
+        return self.slot(tile.tileIdx + offset)
 
     def best(self):
         """returns the candidate with the lowest value"""
@@ -412,4 +466,133 @@ class DiscardCandidates(list):
         result = self.game.randomGenerator.choice(candidates).name.capitalize()
         if Debug.robotAI:
             self.game.debug('%s: discards %s out of %s' % (self.game.myself, result, ' '.join(str(x) for x in self)))
+        if self.profile:
+            self.profile.write(result)
         return result
+
+class AIProfile(object):
+    """what the filters did for one discard decision: their time, the
+    Hand instances they created, the Hand cache hits and the weight
+    changes. Written as one JSON line to the file Debug.aiProfile"""
+
+    def __init__(self, game):
+        self.record = OrderedDict()
+        self.record['handId'] = game.handId()
+        self.record['player'] = game.myself.name
+        self.record['ai'] = game.client.intelligence.name()
+        self.record['moves'] = len(game.moves)
+        self.record['filters'] = []
+        self.started = time.time()
+        self.filterStarted = None
+        self.hands = self.hits = 0
+
+    def startFilter(self):
+        """a filter begins"""
+        self.hands = Hand.created
+        self.hits = Hand.cache.hits
+        self.filterStarted = time.time()
+
+    def endFilter(self, filterName, prevWeights, candidates):
+        """the filter is done"""
+        seconds = time.time() - self.filterStarted
+        changes = OrderedDict()
+        for (name, oldKeep), candidate in zip(prevWeights, candidates):
+            if candidate.keep != oldKeep:
+                changes[name] = candidate.keep - oldKeep
+        self.record['filters'].append(OrderedDict((
+            ('name', filterName),
+            ('seconds', seconds),
+            ('hands', Hand.created - self.hands),
+            ('cacheHits', Hand.cache.hits - self.hits),
+            ('changes', changes))))
+
+    def write(self, choice):
+        """the decision is made"""
+        self.record['choice'] = choice
+        self.record['seconds'] = time.time() - self.started
+        with open(Debug.aiProfile, 'a') as outFile:
+            outFile.write(json.dumps(self.record) + '\n')
+
+class AIRegistry(object):
+    """all AI variants known in this process, by name. These are the
+    AI classes in intelligence.py and altint.py, those found by the
+    setuptools entry points kajongg.ai and those in the python files
+    of the directory ai in appdataDir()"""
+
+    variants = {}
+    warm = set()
+    loaded = False
+
+    def __init__(self):
+        raise Exception('AIRegistry is not meant to be instantiated')
+
+    @staticmethod
+    def register(aiClass):
+        """make aiClass known under its name without the prefix AI"""
+        AIRegistry.variants[aiClass.__name__[2:]] = aiClass
+        return aiClass
+
+    @staticmethod
+    def loadModule(module):
+        """register all AI classes defined in module"""
+        for key, value in module.__dict__.items():
+            if key.startswith('AI') and isinstance(value, type) and issubclass(value, AIDefault):
+                AIRegistry.register(value)
+
+    @staticmethod
+    def loadEntryPoints(group='kajongg.ai'):
+        """register the AI classes of installed packages"""
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        for entryPoint in pkg_resources.iter_entry_points(group):
+            try:
+                AIRegistry.register(entryPoint.load())
+            except Exception as exc: # pylint: disable=W0703
+                logWarning('cannot load AI %s: %s' % (entryPoint.name, exc))
+
+    @staticmethod
+    def loadDirectory(path):
+        """register the AI classes in the python files in path"""
+        if not os.path.isdir(path):
+            return
+        for fileName in sorted(os.listdir(path)):
+            if fileName.endswith('.py'):
+                try:
+                    module = imp.load_source('kajonggai_' + fileName[:-3], os.path.join(path, fileName))
+                except Exception as exc: # pylint: disable=W0703
+                    logWarning('cannot load AI from %s: %s' % (fileName, exc))
+                else:
+                    AIRegistry.loadModule(module)
+
+    @staticmethod
+    def load():
+        """look for AI variants only once per process"""
+        if not AIRegistry.loaded:
+            AIRegistry.loaded = True
+            import altint # pylint: disable=W0404
+            for module in (sys.modules[__name__], altint):
+                AIRegistry.loadModule(module)
+            AIRegistry.loadEntryPoints()
+            AIRegistry.loadDirectory(os.path.join(appdataDir(), 'ai'))
+
+    @staticmethod
+    def names():
+        """the names of all AI variants"""
+        AIRegistry.load()
+        return sorted(AIRegistry.variants)
+
+    @staticmethod
+    def warmUp(aiClass):
+        """let aiClass precompute its tables if it did not yet
+        do so in this process"""
+        if aiClass not in AIRegistry.warm:
+            AIRegistry.warm.add(aiClass)
+            aiClass.warmUp()
+
+def findAI(aiName):
+    """returns the class of AI variant aiName, looking into
+    the AIRegistry. None if it is not defined"""
+    AIRegistry.load()
+    return AIRegistry.variants.get(aiName)
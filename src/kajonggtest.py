@@ -19,7 +19,9 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import os, sys, csv, subprocess, random
+import os, sys, csv, subprocess, random, time, sqlite3
+from multiprocessing import Process, Queue
+from Queue import Empty
 
 from optparse import OptionParser
 
@@ -40,102 +42,202 @@ def neutralize(rows):
                 row[idx] = ','.join(parts)
         yield row
 
-def readGames(csvFile):
-    """returns a dict holding a frozenset of games for each AI variant"""
-    if not os.path.exists(csvFile):
-        return
-    allRows = neutralize(csv.reader(open(csvFile,'r'), delimiter=';'))
-    if not allRows:
+def isSqlite(resultFile):
+    """results go into an sqlite table instead of csv"""
+    return os.path.splitext(resultFile)[1] in ('.db', '.sqlite')
+
+def openSqlite(resultFile):
+    """returns a connection, creating the indexed result table if needed"""
+    connection = sqlite3.connect(resultFile)
+    connection.execute('create table if not exists result(ai text, game integer, row text)')
+    connection.execute('create index if not exists resultgame on result(game, ai)')
+    return connection
+
+def pendingCsv(resultFile):
+    """kajongg clients can only append to a csv file. With a sqlite result
+    file, they write into this one and we import it afterwards"""
+    return resultFile + '.pending.csv'
+
+def readRows(resultFile):
+    """yields all result rows, one at a time"""
+    if not os.path.exists(resultFile):
         return
-    # we want unique tuples so we can work with sets
-    allRows = set(tuple(x) for x in allRows)
-    games = dict()
-    # build set of rows for every ai
-    for aiVariant in set(x[0] for x in allRows):
-        games[aiVariant] = frozenset(x for x in allRows if x[0] == aiVariant)
-    return games
-
-def printDifferingResults(rowLists):
-    """if most games get the same result with all tried AI variants,
-    dump those games that do not"""
-    allGameIds = {}
-    for rows in rowLists:
-        for row in rows:
-            rowId = row[1]
-            if rowId not in allGameIds:
-                allGameIds[rowId] = []
-            allGameIds[rowId].append(row)
-    differing = []
-    for key, value in allGameIds.items():
-        if len(set(tuple(list(x)[1:]) for x in value)) != 1:
-            differing.append(key)
-    if not differing:
-        print 'no games differ'
-    elif float(len(differing)) / len(allGameIds) < 0.20:
-        print 'differing games (%d out of %d): %s' % (len(differing), len(allGameIds),
-             ', '.join(sorted(differing)))
-
-def evaluate(games):
-    """evaluate games"""
-    if not games:
+    if isSqlite(resultFile):
+        connection = openSqlite(resultFile)
+        try:
+            rows = (x[0].encode('utf-8').split(';') for x in connection.execute('select row from result'))
+            for row in neutralize(rows):
+                yield row
+        finally:
+            connection.close()
+    else:
+        with open(resultFile, 'r') as csvFile:
+            for row in neutralize(csv.reader(csvFile, delimiter=';')):
+                yield row
+
+class ResultWriter(object):
+    """appends result rows to a csv file or to the sqlite table. The file
+    stays open until close(), sqlite commits every batchSize rows"""
+
+    batchSize = 100
+
+    def __init__(self, resultFile):
+        self.connection = self.csvFile = self.writer = None
+        self.pending = 0
+        if isSqlite(resultFile):
+            self.connection = openSqlite(resultFile)
+        else:
+            self.csvFile = open(resultFile, 'a')
+            self.writer = csv.writer(self.csvFile, delimiter=';')
+
+    def write(self, row):
+        """append one result row"""
+        if self.connection:
+            self.connection.execute('insert into result values(?,?,?)',
+                (row[0], int(row[1]), ';'.join(str(x) for x in row).decode('utf-8')))
+            self.pending += 1
+            if self.pending >= self.batchSize:
+                self.connection.commit()
+                self.pending = 0
+        else:
+            self.writer.writerow(row)
+            self.csvFile.flush() # a crash should not leave half a row
+
+    def close(self):
+        """commit and close"""
+        if self.connection:
+            self.connection.commit()
+            self.connection.close()
+        else:
+            self.csvFile.close()
+
+def importPending(resultFile):
+    """move the rows written by kajongg clients into the sqlite result file"""
+    pending = pendingCsv(resultFile)
+    if not isSqlite(resultFile) or not os.path.exists(pending):
         return
-    commonGames = None
-    for aiVariant, rows in games.items():
-        gameIds = set(x[1] for x in rows)
-        if len(gameIds) != len(rows):
+    writer = ResultWriter(resultFile)
+    try:
+        with open(pending, 'r') as csvFile:
+            for row in csv.reader(csvFile, delimiter=';'):
+                writer.write(row)
+    finally:
+        writer.close()
+    os.remove(pending)
+
+class Results(object):
+    """built in one pass over all result rows. For every game and AI variant we
+    only keep the row without its first two fields, for every AI variant the
+    sum of balances. Identical rows are counted once. So memory grows with
+    the number of games times AI variants, not with the number of rows:
+    finding conflicting and differing games needs to compare those rows"""
+
+    def __init__(self):
+        self.games = dict() # game id -> {aiVariant: row content}
+        self.conflicts = dict() # aiVariant -> set of game ids with different rows
+        self.totals = dict() # aiVariant -> [row count, four balance sums]
+
+    @staticmethod
+    def read(resultFile):
+        """returns Results for all rows in resultFile"""
+        result = Results()
+        for row in readRows(resultFile):
+            result.add(row)
+        return result
+
+    def add(self, row):
+        """add one result row"""
+        aiVariant, game = row[0], int(row[1])
+        rowContent = tuple(row[2:])
+        variants = self.games.setdefault(game, dict())
+        if aiVariant in variants:
+            if variants[aiVariant] != rowContent:
+                self.conflicts.setdefault(aiVariant, set()).add(game)
+            return
+        variants[aiVariant] = rowContent
+        totals = self.totals.setdefault(aiVariant, [0, 0, 0, 0, 0])
+        totals[0] += 1
+        for playerIdx, balance in enumerate(self.balances(rowContent)):
+            totals[playerIdx + 1] += balance
+
+    @staticmethod
+    def balances(rowContent):
+        """the balances of the four players"""
+        return list(int(rowContent[2+playerIdx*4]) for playerIdx in range(4))
+
+    def aiVariants(self):
+        """all AI variants with results, sorted"""
+        return sorted(self.totals)
+
+    def finished(self):
+        """the set of (aiVariant, game) having a result"""
+        return set((aiVariant, game) for game, variants in self.games.items() for aiVariant in variants)
+
+    def printDifferingResults(self):
+        """if most games get the same result with all tried AI variants,
+        dump those games that do not"""
+        differing = list(game for game, variants in self.games.items()
+            if len(set(variants.values())) != 1)
+        if not differing:
+            print 'no games differ'
+        elif float(len(differing)) / len(self.games) < 0.20:
+            print 'differing games (%d out of %d): %s' % (len(differing), len(self.games),
+                 ', '.join(str(x) for x in sorted(differing)))
+
+    def evaluate(self):
+        """evaluate games"""
+        if not self.games:
+            return
+        for aiVariant in sorted(self.conflicts):
             print 'AI variant "%s" has different rows for games' % aiVariant,
-            for game in gameIds:
-                if len([x for x in rows if x[1] == game]) > 1:
-                    print game,
-            print
+            print ' '.join(str(x) for x in sorted(self.conflicts[aiVariant]))
+        if self.conflicts:
             return
-        if not commonGames:
-            commonGames = gameIds
-        else:
-            commonGames &= gameIds
-    printDifferingResults(games.values())
-    print
-    print 'the 3 robot players always use the Default AI'
-    print
-    print 'common games:'
-    print '{ai:<20} {games:>5}     {points:>4}                      human'.format(
-        ai='AI variant', games='games', points='points')
-    for aiVariant, rows in games.items():
-        print '{ai:<20} {games:>5}  '.format(ai=aiVariant[:20], games=len(commonGames)),
-        for playerIdx in range(4):
-            print '{p:>8}'.format(p=sum(int(x[4+playerIdx*4]) for x in rows if x[1] in commonGames)),
+        aiVariants = self.aiVariants()
+        commonCount = 0
+        commonSums = dict((x, [0, 0, 0, 0]) for x in aiVariants)
+        for variants in self.games.values():
+            if len(variants) == len(aiVariants):
+                commonCount += 1
+                for aiVariant, rowContent in variants.items():
+                    for playerIdx, balance in enumerate(self.balances(rowContent)):
+                        commonSums[aiVariant][playerIdx] += balance
+        self.printDifferingResults()
         print
-    print
-    print 'all games:'
-    for aiVariant, rows in games.items():
-        if len(rows) > len(commonGames):
-            print '{ai:<20} {rows:>5}  '.format(ai=aiVariant[:20], rows=len(rows)),
+        print 'the 3 robot players always use the Default AI'
+        print
+        print 'common games:'
+        print '{ai:<20} {games:>5}     {points:>4}                      human'.format(
+            ai='AI variant', games='games', points='points')
+        for aiVariant in aiVariants:
+            print '{ai:<20} {games:>5}  '.format(ai=aiVariant[:20], games=commonCount),
             for playerIdx in range(4):
-                print '{p:>8}'.format(p=sum(int(x[4+playerIdx*4]) for x in rows)),
+                print '{p:>8}'.format(p=commonSums[aiVariant][playerIdx]),
             print
+        print
+        print 'all games:'
+        for aiVariant in aiVariants:
+            totals = self.totals[aiVariant]
+            if totals[0] > commonCount:
+                print '{ai:<20} {rows:>5}  '.format(ai=aiVariant[:20], rows=totals[0]),
+                for playerIdx in range(4):
+                    print '{p:>8}'.format(p=totals[playerIdx + 1]),
+                print
 
-def proposeGames(games, optionAIVariants):
-    """fill holes: returns games for testing such that the csv file
-    holds more games tested for all AI variants"""
-    if not games:
-        return []
-    for key, value in games.items():
-        games[key] = frozenset(int(x[1]) for x in value)  # we only want the game
-    for aiVariant in optionAIVariants.split(','):
-        if aiVariant not in games:
-            games[aiVariant] = frozenset()
-    allgames = reduce(lambda x, y: x|y, games.values())
-    occ = []
-    for game in allgames:
-        count = sum(game in x for x in games.values())
-        if count < len(games.values()):
-            occ.append((game, count))
-    result = []
-    for game in list(x[0] for x in sorted(occ, key=lambda x: -x[1])):
-        for aiVariant, ids in games.items():
-            if game not in ids:
-                result.append((aiVariant, game))
-    return result
+    def proposeGames(self, optionAIVariants):
+        """fill holes: returns games for testing such that the result file
+        holds more games tested for all AI variants"""
+        if not self.games:
+            return []
+        aiVariants = sorted(set(self.aiVariants()) | set(optionAIVariants.split(',')))
+        occ = list((game, len(variants)) for game, variants in self.games.items()
+            if len(variants) < len(aiVariants))
+        result = []
+        for game, _ in sorted(occ, key=lambda x: -x[1]):
+            for aiVariant in aiVariants:
+                if aiVariant not in self.games[game]:
+                    result.append((aiVariant, game))
+        return result
 
 def startServers(options):
     """starts count servers and returns a list of them"""
@@ -163,6 +265,7 @@ def doJobs(jobs, options, serverProcesses):
     # pylint: disable=R0912
     # too many local branches
     srcDir = os.path.dirname(sys.argv[0])
+    clientCsv = pendingCsv(options.csv) if isSqlite(options.csv) else options.csv
     clients = [None] * options.clients
     srvIdx = 0
     try:
@@ -182,7 +285,7 @@ def doJobs(jobs, options, serverProcesses):
                 cmd = ['{src}/kajongg.py'.format(src=srcDir),
                       '--game={game}'.format(game=game),
                       '--socket={sock}'.format(sock=serverProcesses[srvIdx][1]),
-                      '--csv={csv}'.format(csv=options.csv),
+                      '--csv={csv}'.format(csv=clientCsv),
                       '--player=Tester {player}'.format(player=player),
                       '--ruleset={ap}'.format(ap=options.ruleset)]
                 if aiVariant != 'Default':
@@ -198,6 +301,7 @@ def doJobs(jobs, options, serverProcesses):
                 clients[qIdx] = subprocess.Popen(cmd)
                 srvIdx += 1
                 srvIdx %= len(serverProcesses)
+            time.sleep(0.1) # do not poll busily
 #    except KeyboardInterrupt:
 #        pass
     finally:
@@ -205,6 +309,86 @@ def doJobs(jobs, options, serverProcesses):
             if client:
                 _ = os.waitpid(client.pid, 0)[1]
 
+def withoutFinished(jobs, results):
+    """for resuming: remove jobs which already have a result"""
+    finished = results.finished()
+    return list(x for x in jobs if x not in finished)
+
+def playInProcess(jobs, options, putResult):
+    """play jobs with the simulator. putResult gets the csv row
+    for each job, or None if the game did not end normally"""
+    from simulator import Simulator, findRuleset
+    simulator = Simulator(findRuleset(options.ruleset), playOpen=options.playopen)
+    for aiVariant, game in jobs:
+        putResult(simulator.play(game, aiVariant))
+
+def doJobsInProcess(jobs, options):
+    """execute all jobs within this process, without servers and clients"""
+    from query import initDb
+    if not initDb():
+        sys.exit(1)
+    writer = ResultWriter(options.csv)
+    def putResult(row):
+        """write the row at once"""
+        if row:
+            writer.write(row)
+    try:
+        playInProcess(jobs, options, putResult)
+    finally:
+        writer.close()
+
+def playShard(workerIdx, jobs, options, results):
+    """a worker process playing its share of jobs. It uses its own
+    copy of the data base, sqlite does not like concurrent writers"""
+    from simulator import initPrivateDb
+    dbPath = '{csv}.worker{idx}.db'.format(csv=options.csv, idx=workerIdx)
+    try:
+        if initPrivateDb(dbPath):
+            playInProcess(jobs, options, lambda row: results.put(('row', row)))
+    finally:
+        results.put(('done', workerIdx))
+        removeIfExists(dbPath)
+
+def doJobsInWorkers(jobs, options):
+    """distribute jobs to worker processes by game id. Only this
+    process writes the csv file"""
+    shards = list([] for _ in range(options.workers))
+    for job in jobs:
+        shards[job[1] % options.workers].append(job)
+    results = Queue()
+    workers = list(Process(target=playShard, args=(idx, shard, options, results))
+        for idx, shard in enumerate(shards) if shard)
+    for worker in workers:
+        worker.start()
+    running = len(workers)
+    done = 0
+    startTime = time.time()
+    writer = ResultWriter(options.csv)
+    try:
+        while running:
+            try:
+                kind, value = results.get(timeout=10)
+            except Empty:
+                if not any(x.is_alive() for x in workers):
+                    print 'all workers died'
+                    break
+                continue
+            if kind == 'done':
+                running -= 1
+                continue
+            done += 1
+            if value:
+                writer.write(value)
+            else:
+                print 'a game did not end normally'
+            minutes = (time.time() - startTime) / 60
+            print '{done}/{total} games, {rate:.1f} games per minute'.format(
+                done=done, total=len(jobs), rate=done / max(minutes, 0.001))
+    finally:
+        writer.close()
+        for worker in workers:
+            worker.join()
+
 def parse_options():
     """parse options"""
     parser = OptionParser()
@@ -217,7 +401,8 @@ def parse_options():
         default=None, help='use AI variants: comma separated list',
         metavar='AI')
     parser.add_option('', '--csv', dest='csv',
-        default='kajongg.csv', help='write results to CSV',
+        default='kajongg.csv', help='write results to CSV. If CSV ends with .db or .sqlite,'
+            ' use an sqlite table instead',
         metavar='CSV')
     parser.add_option('', '--game', dest='game',
         help='start first game with GAMEID, increment for following games.'
@@ -236,6 +421,11 @@ def parse_options():
         metavar='SERVERS', type=int, default=0)
     parser.add_option('', '--fill', dest='fill', action='store_true',
         help='fill holes in results', default=False)
+    parser.add_option('', '--inprocess', dest='inprocess', action='store_true',
+        help='play all games within this process, without servers and clients', default=False)
+    parser.add_option('', '--workers', dest='workers',
+        help='play in WORKERS processes, without servers and clients. Implies --inprocess',
+        metavar='WORKERS', type=int, default=0)
     parser.add_option('', '--debug', dest='debug',
         help=Debug.help())
 
@@ -246,10 +436,33 @@ def improve_options(options):
     if options.game and not options.count:
         options.count = 1
     options.clients = min(options.clients, options.count)
+    if options.workers:
+        options.inprocess = True
     if options.servers == 0:
         options.servers = max(1, options.clients // 2)
     return options
 
+def newJobs(options):
+    """jobs for new games as requested by --game and --count"""
+    if options.game:
+        games = list(range(int(options.game), options.game+options.count))
+    else:
+        games = list(int(random.random() * 10**9) for _ in range(options.count))
+    jobs = []
+    allAis = options.aiVariants.split(',')
+    for game in games:
+        jobs.extend([(x, game) for x in allAis])
+    return jobs
+
+def allJobs(options, results):
+    """first fill holes if wanted, then new games"""
+    jobs = []
+    if options.fill:
+        jobs.extend(results.proposeGames(options.aiVariants))
+    if options.count:
+        jobs.extend(newJobs(options))
+    return jobs
+
 def main():
     """parse options, play, evaluate results"""
     print
@@ -267,7 +480,8 @@ def main():
         print 'unrecognized arguments:', ' '.join(args)
         sys.exit(2)
 
-    evaluate(readGames(options.csv))
+    importPending(options.csv) # from an interrupted run
+    Results.read(options.csv).evaluate()
 
     if not options.count and not options.fill:
         sys.exit(0)
@@ -275,26 +489,29 @@ def main():
     if not options.aiVariants:
         options.aiVariants = 'Default'
 
-    serverProcesses = startServers(options)
-    try:
-        if options.fill:
-            jobs = proposeGames(readGames(options.csv), options.aiVariants)
-            doJobs(jobs, options, serverProcesses)
-
-        if options.count:
-            if options.game:
-                games = list(range(int(options.game), options.game+options.count))
-            else:
-                games = list(int(random.random() * 10**9) for _ in range(options.count))
-            jobs = []
-            allAis = options.aiVariants.split(',')
-            for game in games:
-                jobs.extend([(x, game) for x in allAis])
-            doJobs(jobs, options, serverProcesses)
-    finally:
-        stopServers(serverProcesses)
+    if options.inprocess:
+        if options.gui:
+            print '--gui and --inprocess cannot be combined'
+            sys.exit(2)
+        results = Results.read(options.csv)
+        jobs = withoutFinished(allJobs(options, results), results)
+        if options.workers > 1:
+            doJobsInWorkers(jobs, options)
+        else:
+            doJobsInProcess(jobs, options)
+    else:
+        serverProcesses = startServers(options)
+        try:
+            if options.fill:
+                jobs = Results.read(options.csv).proposeGames(options.aiVariants)
+                doJobs(jobs, options, serverProcesses)
+            if options.count:
+                doJobs(newJobs(options), options, serverProcesses)
+        finally:
+            stopServers(serverProcesses)
+            importPending(options.csv)
 
-    evaluate(readGames(options.csv))
+    Results.read(options.csv).evaluate()
 
 # is one server for two clients.
 if __name__ == '__main__':
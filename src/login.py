@@ -528,13 +528,18 @@ class Connection(object):
         logWarning(msg)
         return failure
 
-    def pingLater(self, dummyResult=None):
-        """ping the server every 5 seconds"""
-        Internal.reactor.callLater(5, self.ping) # pylint: disable=E1101
+    def pingLater(self, dummyResult=None, delay=5):
+        """ping the server after 5 seconds"""
+        Internal.reactor.callLater(delay, self.ping) # pylint: disable=E1101
 
     def ping(self):
-        """regularly check if server is still there"""
+        """regularly check if server is still there. The server counts every
+        message as a sign of life, so we only ping if we have been quiet"""
         if self.client.connection:
             # when pinging starts, we do have a connection and when the
             # connection goes away, it does not come back
+            quiet = time.time() - self.client.lastTraffic
+            if quiet < 5:
+                self.pingLater(delay=5 - quiet)
+                return
             self.client.callServer('ping').addCallback(self.pingLater).addErrback(self.client.remote_serverDisconnects)
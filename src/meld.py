@@ -389,3 +389,96 @@ def hasChows(tileName, within):
             if chow not in chows:
                 chows.append(chow)
     return chows
+
+class SuitDecomposer(object):
+    """splits the tiles of one suit into melds. The tiles are given as a
+    9-tuple with the counts for the values 1..9, a meld is a tuple of values.
+    There are only a few thousand reachable counts tuples, so we remember
+    the decompositions for each of them."""
+
+    cache = dict()
+    partialCache = dict()
+
+    @staticmethod
+    def variants(counts, maxPairs=1):
+        """a sorted list of all complete decompositions of counts into
+        pungs (for exactly three equal tiles), pairs (for exactly two,
+        at most maxPairs of them) and chows. Each decomposition is a
+        sorted tuple of melds."""
+        cacheKey = (counts, maxPairs)
+        result = SuitDecomposer.cache.get(cacheKey)
+        if result is None:
+            result = sorted(SuitDecomposer.__decompose(counts, maxPairs))
+            SuitDecomposer.cache[cacheKey] = result
+        return result
+
+    @staticmethod
+    def __decompose(counts, pairsLeft):
+        """returns a set of decompositions. The lowest value must be part of
+        one of the melds, so we only need to try melds starting with it"""
+        if not any(counts):
+            return set([()])
+        cacheKey = (counts, pairsLeft)
+        if cacheKey in SuitDecomposer.cache:
+            return set(SuitDecomposer.cache[cacheKey])
+        value = 0
+        while not counts[value]:
+            value += 1
+        count = counts[value]
+        melds = []
+        if count == 3:
+            melds.append((value + 1,) * 3)
+        elif count == 2 and pairsLeft:
+            melds.append((value + 1,) * 2)
+        if value < 7 and counts[value + 1] and counts[value + 2]:
+            melds.append((value + 1, value + 2, value + 3))
+        result = set()
+        for meld in melds:
+            rest = list(counts)
+            for meldValue in meld:
+                rest[meldValue - 1] -= 1
+            for variant in SuitDecomposer.__decompose(tuple(rest), pairsLeft - (len(meld) == 2)):
+                result.add(tuple(sorted(variant + (meld,))))
+        SuitDecomposer.cache[cacheKey] = sorted(result)
+        return result
+
+    @staticmethod
+    def partials(counts):
+        """all ways to pick complete sets and partial sets out of counts,
+        leaving the other tiles alone. Returns a set of tuples
+        (sets, partials, heads, chows): partials are pairs or incomplete
+        chows, heads are pairs meant as the pair of a standard hand, chows
+        counts complete and incomplete chows. For honors pass a 1-tuple."""
+        result = SuitDecomposer.partialCache.get(counts)
+        if result is not None:
+            return result
+        if not any(counts):
+            result = set([(0, 0, 0, 0)])
+        else:
+            value = 0
+            while not counts[value]:
+                value += 1
+            count = counts[value]
+            picks = [((value,), (0, 0, 0, 0))] # leave this tile alone
+            if count >= 3:
+                picks.append(((value,) * 3, (1, 0, 0, 0)))
+            if count >= 2:
+                picks.append(((value,) * 2, (0, 1, 0, 0)))
+                picks.append(((value,) * 2, (0, 0, 1, 0)))
+            if value + 1 < len(counts) and counts[value + 1]:
+                picks.append(((value, value + 1), (0, 1, 0, 1)))
+                if value + 2 < len(counts) and counts[value + 2]:
+                    picks.append(((value, value + 1, value + 2), (1, 0, 0, 1)))
+            if value + 2 < len(counts) and counts[value + 2]:
+                picks.append(((value, value + 2), (0, 1, 0, 1)))
+            result = set()
+            for values, found in picks:
+                rest = list(counts)
+                for pickedValue in values:
+                    rest[pickedValue] -= 1
+                for sets, partials, heads, chows in SuitDecomposer.partials(tuple(rest)):
+                    if heads + found[2] < 2:
+                        result.add((sets + found[0], partials + found[1],
+                            heads + found[2], chows + found[3]))
+        SuitDecomposer.partialCache[counts] = result
+        return result
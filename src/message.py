@@ -297,7 +297,7 @@ class MessageDiscard(ClientMessage, ServerMessage):
             txt.append(m18n('discarding %1 violates Original Call',
                 Meld.tileName(tile.element)))
             warn = True
-        if game.dangerousFor(myself, tile):
+        if game.isDangerousFor(myself, tile):
             txt.append(m18n('discarding %1 is Dangerous Game',
                 Meld.tileName(tile.element)))
             warn = True
@@ -344,7 +344,8 @@ class MessageReadyForGameStart(ServerMessage):
         # move.source are the players in seating order
         # we cannot just use table.playerNames - the seating order is now different (random)
         return client.readyForGameStart(move.tableid, move.gameid,
-            move.wantedGame, move.source, shouldSave=move.shouldSave).addCallback(hideTableList)
+            move.wantedGame, move.source, shouldSave=move.shouldSave,
+            fastForward=move.kwargs.get('fastForward', False)).addCallback(hideTableList)
 
 class MessageNoGameStart(NotifyAtOnceMessage):
     """the client says he does not want to start the game after all"""
@@ -35,6 +35,7 @@ class Move(object):
         self.kwargs = kwargs.copy()
         del self.kwargs['token']
         self.score = None
+        self.scoreHash = None
         self.lastMeld = None
         for key, value in kwargs.items():
             self.__setattr__(key, value)
@@ -20,13 +20,70 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import sys, weakref
 from collections import defaultdict
+from itertools import count
 
 from util import logException, logWarning, m18n, m18nc, m18nE
-from common import WINDS, Internal, elements, IntDict, Debug
+from common import WINDS, Internal, elements, Debug
 from query import Transaction, Query
-from tile import Tile
+from tile import Tile, TileCounter, TILEIDS, BONUSBASE, tileName
 from meld import Meld, CONCEALED, PUNG, hasChows, meldsContent
 from hand import Hand
+from rulecode import EastWonNineTimesInARow
+
+class PlayerSnapshot(object):
+    """what Hand and the rules need from a Player, taken in the reactor
+    thread. The server evaluates hands of the snapshot in another thread
+    while the reactor thread goes on changing the player and the game.
+    The game is still shared, but Hand only reads what does not change
+    during a hand from it: ruleset, serial and the client"""
+
+    def __init__(self, player):
+        self.name = player.name
+        self.game = player.game
+        self.__unseen = player.unseenTiles()
+        self.__eastWonNineTimes = player.eastWonNineTimes()
+        # the live player may already differ, so we get our own cache entries
+        self.serial = (player.serial, tuple(self.__unseen), self.__eastWonNineTimes)
+
+    def __str__(self):
+        return self.name
+
+    def tileAvailable(self, tileName, hand):
+        """like Player.tileAvailable"""
+        tileIdx = TILEIDS[tileName]
+        return self.__unseen[tileIdx] - hand.counts[tileIdx]
+
+    def eastWonNineTimes(self):
+        """like Player.eastWonNineTimes"""
+        return self.__eastWonNineTimes
+
+class Danger(object):
+    """the reasons why discarding a tile might be Dangerous Game. Every
+    reason is one bit in the masks of Player.dangerousMask"""
+    green = 1
+    trueColor = 2
+    terminals = 4
+    winds = 8
+    dragons = 16
+
+    def __init__(self):
+        raise Exception('Danger is not meant to be instantiated')
+
+    @staticmethod
+    def texts(mask, pName):
+        """the explaining texts for all reasons in mask"""
+        result = []
+        if mask & Danger.green:
+            result.append(m18n('Player %1 has 3 or 4 exposed melds, all are green', pName))
+        if mask & Danger.trueColor:
+            result.append(m18n('Player %1 may try a True Color Game', pName))
+        if mask & Danger.terminals:
+            result.append(m18n('Player %1 may try an All Terminals Game', pName))
+        if mask & Danger.winds:
+            result.append(m18n('Player %1 exposed many winds', pName))
+        if mask & Danger.dragons:
+            result.append(m18n('Player %1 exposed many dragons', pName))
+        return result
 
 class Players(list):
     """a list of players where the player can also be indexed by wind.
@@ -110,7 +167,10 @@ class Player(object):
     # pylint: disable=R0904
     # pylint we need more than 40 public methods
 
+    serials = count(1)
+
     def __init__(self, game):
+        self.serial = next(Player.serials) # never reused, unlike id(self)
         if game:
             self._game = weakref.ref(game)
         else:
@@ -120,7 +180,7 @@ class Player(object):
         self.wonCount = 0
         self.name = ''
         self.wind = WINDS[0]
-        self.visibleTiles = IntDict(game.visibleTiles) if game else IntDict()
+        self.visibleTiles = TileCounter(game.visibleTiles) if game else TileCounter()
         self.clearHand()
         self.__lastSource = '1' # no source: blessing from heaven or earth
         self.voice = None
@@ -156,7 +216,7 @@ class Player(object):
         self.__mayWin = True
         self.__payment = 0
         self.originalCall = False
-        self.dangerousTiles = list()
+        self.dangerousMask = [0] * BONUSBASE # for each tile id: bits of Danger
         self.claimedNoChoice = False
         self.playedDangerous = False
         self.usedDangerousFrom = None
@@ -434,16 +494,19 @@ class Player(object):
             self.game.lastDiscard = Tile(tileName)
         self.game.lastDiscard.element = self.game.lastDiscard.upper()
 
-    def scoreMatchesServer(self, score):
-        """do we compute the same score as the server does?"""
-        if score is None:
+    def scoreMatchesServer(self, score, scoreHash=None):
+        """do we compute the same score as the server does? The server
+        sends either the score string or its scoreHash"""
+        if score is None and scoreHash is None:
             return True
         if 'Xy' in self.__concealedTileNames:
             return True
-        if str(self.hand) == score:
+        if score is not None and str(self.hand) == score:
+            return True
+        if scoreHash is not None and Hand.scoreHash(str(self.hand)) == scoreHash:
             return True
         self.game.debug('%s localScore:%s' % (self, self.hand))
-        self.game.debug('%s serverScore:%s' % (self, score))
+        self.game.debug('%s serverScore:%s' % (self, score if score is not None else 'hash ' + scoreHash))
         logWarning('Game %s: client and server disagree about scoring, see logfile for details' % self.game.seed)
         return False
 
@@ -466,7 +529,7 @@ class Player(object):
                 if tileName.lower() in afterExposed:
                     # the "if" is needed for claimed pung
                     afterExposed.remove(tileName.lower())
-        return all(self.game.dangerousFor(self, x) for x in afterExposed)
+        return all(self.game.isDangerousFor(self, x) for x in afterExposed)
 
     def exposeMeld(self, meldTiles, calledTile=None):
         """exposes a meld with meldTiles: removes them from concealedTileNames,
@@ -501,14 +564,14 @@ class Player(object):
         return meld
 
     def findDangerousTiles(self):
-        """update the list of dangerous tile"""
-        pName = self.localName
-        dangerous = list()
+        """update the reasons why discarding a tile to us is dangerous.
+        They only depend on our own exposed melds"""
+        dangerous = [0] * BONUSBASE
         expMeldCount = len(self._exposedMelds)
         if expMeldCount >= 3:
             if all(x in elements.greenHandTiles for x in self.visibleTiles):
-                dangerous.append((elements.greenHandTiles,
-                     m18n('Player %1 has 3 or 4 exposed melds, all are green', pName)))
+                for tile in elements.greenHandTiles:
+                    dangerous[TILEIDS[tile]] |= Danger.green
             color = defaultdict.keys(self.visibleTiles)[0][0]
             # see http://www.logilab.org/ticket/23986
             assert color.islower(), self.visibleTiles
@@ -516,10 +579,11 @@ class Player(object):
                 if all(x[0] == color for x in self.visibleTiles):
                     suitTiles = set([color+x for x in '123456789'])
                     if self.visibleTiles.count(suitTiles) >= 9:
-                        dangerous.append((suitTiles, m18n('Player %1 may try a True Color Game', pName)))
+                        for tile in suitTiles:
+                            dangerous[TILEIDS[tile]] |= Danger.trueColor
                 elif all(x[1] in '19' for x in self.visibleTiles):
-                    dangerous.append((elements.terminals,
-                        m18n('Player %1 may try an All Terminals Game', pName)))
+                    for tile in elements.terminals:
+                        dangerous[TILEIDS[tile]] |= Danger.terminals
         if expMeldCount >= 2:
             windMelds = sum(self.visibleTiles[x] >=3 for x in elements.winds)
             dragonMelds = sum(self.visibleTiles[x] >=3 for x in elements.dragons)
@@ -529,14 +593,17 @@ class Player(object):
             windsDangerous = windsDangerous or windMelds >= 3
             dragonsDangerous = dragonsDangerous or dragonMelds >= 2
             if windsDangerous:
-                dangerous.append((set(x for x in elements.winds if x not in self.visibleTiles),
-                     m18n('Player %1 exposed many winds', pName)))
+                for tile in elements.winds:
+                    if tile not in self.visibleTiles:
+                        dangerous[TILEIDS[tile]] |= Danger.winds
             if dragonsDangerous:
-                dangerous.append((set(x for x in elements.dragons if x not in self.visibleTiles),
-                     m18n('Player %1 exposed many dragons', pName)))
-        self.dangerousTiles = dangerous
-        if dangerous and Debug.dangerousGame:
-            self.game.debug('dangerous:%s' % dangerous)
+                for tile in elements.dragons:
+                    if tile not in self.visibleTiles:
+                        dangerous[TILEIDS[tile]] |= Danger.dragons
+        self.dangerousMask = dangerous
+        if any(dangerous) and Debug.dangerousGame:
+            self.game.debug('dangerous:%s' % ' '.join('%s:%s' % (
+                tileName(idx), Danger.texts(mask, self.localName)) for idx, mask in enumerate(dangerous) if mask))
 
     def popupMsg(self, msg):
         """virtual: show popup on display"""
@@ -583,6 +650,11 @@ class Player(object):
 
     def computeHand(self, withTile=None, robbedTile=None, dummy=None, asWinner=False):
         """returns Hand for this player"""
+        return Hand.cached(self, self.handString(withTile, asWinner), robbedTile=robbedTile)
+
+    def handString(self, withTile=None, asWinner=False):
+        """the string for computeHand. This does not evaluate anything, so the
+        server can take it as a snapshot and evaluate it in a thread"""
         assert not (self._concealedMelds and self.__concealedTileNames)
         assert not isinstance(self.lastTile, Tile)
         assert not isinstance(withTile, Tile)
@@ -596,7 +668,7 @@ class Player(object):
         melds.append(mjString)
         if mjString.startswith('M') and (withTile or self.lastTile):
             melds.append('L%s%s' % (withTile or self.lastTile, self.lastMeld.joined))
-        return Hand.cached(self, ' '.join(melds), robbedTile=robbedTile)
+        return ' '.join(melds)
 
     def computeNewHand(self):
         """returns the new hand. Same as current unless we need to discard. In that
@@ -703,15 +775,32 @@ class Player(object):
 
     def tileAvailable(self, tileName, hand):
         """a count of how often tileName might still appear in the game
-        supposing we have hand"""
-        visible = self.game.discardedTiles.count([tileName.lower()])
-        for player in self.others():
-            visible += player.visibleTiles.count([tileName.capitalize()])
-            visible += player.visibleTiles.count([tileName.lower()])
-        for pair in hand.tileNames:
-            if pair.lower() == tileName.lower():
-                visible += 1
-        return 4 - visible
+        supposing we have hand. The game counts all discarded and exposed
+        tiles, we only have to remove our own exposed tiles because
+        they are also in hand"""
+        tileIdx = TILEIDS[tileName]
+        result = (4 - self.game.visibleTiles.counts[tileIdx]
+            + self.visibleTiles.counts[tileIdx] - hand.counts[tileIdx])
+        if Debug.tileCounts:
+            visible = self.game.discardedTiles.count([tileName.lower()])
+            for player in self.others():
+                visible += player.visibleTiles.count([tileName.capitalize()])
+                visible += player.visibleTiles.count([tileName.lower()])
+            for pair in hand.tileNames:
+                if pair.lower() == tileName.lower():
+                    visible += 1
+            assert result == 4 - visible, '%s: tileAvailable(%s) is %d, should be %d' % (
+                self, tileName, result, 4 - visible)
+        return result
+
+    def unseenTiles(self):
+        """tileAvailable for an empty hand: a list indexed like TILEIDS"""
+        return [4 - x + y for x, y in zip(self.game.visibleTiles.counts, self.visibleTiles.counts)]
+
+    def eastWonNineTimes(self):
+        """the rule East Won Nine Times In A Row asks the player and not
+        the game, so PlayerSnapshot can freeze the answer"""
+        return EastWonNineTimesInARow.appliesToGame(self.game)
 
     def violatesOriginalCall(self, tileName=None):
         """called if discarding tileName (default=just discarded tile)
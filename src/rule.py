@@ -270,9 +270,11 @@ class Ruleset(object):
         self.__dirty = False # only the ruleset editor is supposed to make us dirty
         self.__loaded = False
         self.__filteredLists = {}
+        self.__ruleIndex = {}
         self.description = None
         self.rawRules = None # used when we get the rules over the network
         self.splitRules = []
+        self.meldRuleMemo = {} # which meld rules apply to a meld, see Hand
         self.doublingMeldRules = []
         self.doublingHandRules = []
         self.meldRules = RuleList(1, m18n('Meld Rules'),
@@ -308,6 +310,8 @@ into a situation where you have to pay a penalty"""))
         """have we been modified since load or last save?"""
         self.__dirty = dirty
         if dirty:
+            self.meldRuleMemo.clear()
+            self.__ruleIndex.clear()
             self.__computeHash()
 
     @property
@@ -318,6 +322,13 @@ into a situation where you have to pay a penalty"""))
         return self.__hash
 
 
+    @property
+    def scoringKey(self):
+        """the hash plus the current values of all parameters. They may have been
+        changed after loading, like roofOff in scoringtest.py"""
+        self.load()
+        return self.hash, tuple(self.__dict__[x.parName] for x in self.parameterRules)
+
     def __eq__(self, other):
         """two rulesets are equal if everything except name or description is identical.
         The name might be localized."""
@@ -383,8 +394,28 @@ into a situation where you have to pay a penalty"""))
                 self.allRules.append(rule)
         self.doublingMeldRules = list(x for x in self.meldRules if x.score.doubles)
         self.doublingHandRules = list(x for x in self.handRules if x.score.doubles)
+        self.__buildRuleIndex()
         return self
 
+    def __buildRuleIndex(self):
+        """for every combination of suits a hand can have, find the rules
+        which might apply. Hands with hidden tiles get theirs when needed"""
+        self.__ruleIndex.clear()
+        allSuits = 'sbcwd'
+        for bits in range(1 << len(allSuits)):
+            suits = set(x for idx, x in enumerate(allSuits) if bits & (1 << idx))
+            for ruleList in (self.handRules, self.winnerRules, self.loserRules, self.mjRules):
+                self.candidateRules(ruleList, suits)
+
+    def candidateRules(self, ruleList, suits):
+        """the rules in ruleList which might apply to a hand with suits"""
+        key = (ruleList.listId, frozenset(suits))
+        result = self.__ruleIndex.get(key)
+        if result is None:
+            result = list(x for x in ruleList if not x.function or x.function.mayApplyToSuits(key[1]))
+            self.__ruleIndex[key] = result
+        return result
+
     def __loadQuery(self):
         """returns a Query object with loaded ruleset"""
         return Query(
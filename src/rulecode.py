@@ -21,8 +21,11 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 Read the user manual for a description of the interface to this scoring engine
 """
 
-from meld import Meld, CONCEALED, EXPOSED, CLAIMEDKONG, REST, elementKey
+import threading
+
+from meld import Meld, CONCEALED, EXPOSED, CLAIMEDKONG, REST, elementKey, SuitDecomposer
 from common import elements, IntDict, WINDS
+from tile import TILEIDS, HONORBASE, BONUSBASE, tileName, tileCounts, suitCounts
 from message import Message
 from query import Query
 
@@ -33,9 +36,21 @@ class Function(object):
 
     functions = {}
 
+    # cheap preconditions on the suits of a hand (hand.suits). Ruleset
+    # uses them to skip rules which cannot apply to a hand:
+    needSuits = ''   # all of them must be in the hand
+    onlySuits = None # the hand may have no other suits
+    maxSuits = 5     # the hand may have no more different suits
+
     def __init__(self):
         self.options = {}
 
+    def mayApplyToSuits(self, suits):
+        """False if a hand with those suits cannot match"""
+        return (len(suits) <= self.maxSuits
+            and set(self.needSuits) <= suits
+            and (self.onlySuits is None or suits <= set(self.onlySuits)))
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -183,23 +198,30 @@ class OnlyConcealedMelds(Function):
         return not any((x.state == EXPOSED and x.meldType != CLAIMEDKONG) for x in hand.melds)
 
 class FalseColorGame(Function):
+    maxSuits = 3
     @staticmethod
     def appliesToHand(hand):
         dwSet = set('dw')
         return dwSet & hand.suits and len(hand.suits - dwSet) == 1
 
 class TrueColorGame(Function):
+    onlySuits = 'sbc'
+    maxSuits = 1
     @staticmethod
     def appliesToHand(hand):
         return len(hand.suits) == 1 and hand.suits < set('sbc')
 
 class Purity(Function):
+    onlySuits = 'sbc'
+    maxSuits = 1
     @staticmethod
     def appliesToHand(hand):
         return (len(hand.suits) == 1 and hand.suits < set('sbc')
             and not any(x.isChow() for x in hand.melds))
 
 class ConcealedTrueColorGame(Function):
+    onlySuits = 'sbc'
+    maxSuits = 1
     @staticmethod
     def appliesToHand(hand):
         if len(hand.suits) != 1 or not (hand.suits < set('sbc')):
@@ -212,6 +234,7 @@ class OnlyMajors(Function):
         return not set(hand.values) - set('grbeswn19')
 
 class OnlyHonors(Function):
+    onlySuits = 'wd'
     @staticmethod
     def appliesToHand(hand):
         return not set(hand.values) - set('grbeswn')
@@ -224,6 +247,7 @@ class HiddenTreasure(Function):
             and len(hand.melds) == 5)
 
 class BuriedTreasure(Function):
+    maxSuits = 3
     @staticmethod
     def appliesToHand(hand):
         return (len(hand.suits - set('dw')) == 1
@@ -231,11 +255,14 @@ class BuriedTreasure(Function):
             and all((x.isPung() and x.state == CONCEALED) or x.isPair() for x in hand.melds))
 
 class AllTerminals(Function):
+    onlySuits = 'sbc'
     @staticmethod
     def appliesToHand(hand):
         return not set(hand.values) - set('19')
 
 class SquirmingSnake(Function):
+    onlySuits = 'sbc'
+    maxSuits = 1
     @staticmethod
     def computeLastMelds(hand):
         return StandardMahJongg.computeLastMelds(hand)
@@ -253,6 +280,8 @@ class SquirmingSnake(Function):
         return len(set(values)) == len(values) - 5
 
 class WrigglingSnake(Function):
+    needSuits = 'w'
+    maxSuits = 2
     @staticmethod
     def shouldTry(dummyHand, dummyMaxMissing=3):
 # TODO: do more about this. Game=115
@@ -285,18 +314,19 @@ class WrigglingSnake(Function):
 class CallingHand(Function):
     def __init__(self):
         Function.__init__(self)
-        self.active = False
+        self.active = threading.local() # the server evaluates in threads
         self.limitHand = None
 
     def appliesToHand(self, hand):
-        if self.active:
+        if getattr(self.active, 'value', False):
             return False
         if hand.lenOffset != 0:
             return False
         if not self.limitHand:
-            self.limitHand = Function.functions[self.options['hand']]()
-            self.limitHand.options = self.options
-        self.active = True
+            limitHand = Function.functions[self.options['hand']]()
+            limitHand.options = self.options
+            self.limitHand = limitHand
+        self.active.value = True
         try:
             if hasattr(self.limitHand, 'winningTileCandidates'):
                 candidates = self.limitHand.winningTileCandidates(hand)
@@ -308,9 +338,10 @@ class CallingHand(Function):
                     return True
             return False
         finally:
-            self.active = False
+            self.active.value = False
 
 class TripleKnitting(Function):
+    onlySuits = 'sbc'
 
     def computeLastMelds(self, hand):
         """returns all possible last melds"""
@@ -410,6 +441,7 @@ class TripleKnitting(Function):
         return result, tilesS + tilesB + tilesC
 
 class Knitting(Function):
+    onlySuits = 'sbc'
     def computeLastMelds(self, hand):
         """returns all possible last melds"""
         if not hand.lastTile:
@@ -518,6 +550,13 @@ class AllPairHonors(Function):
             result[Message.Chow] = -999
         return result
     @staticmethod
+    def missingTiles(hand, counts):
+        """seven different pairs of majors"""
+        if hand.declaredMelds:
+            return None
+        useful = sorted((min(counts[TILEIDS[x]], 2) for x in elements.majors), reverse=True)
+        return 14 - sum(useful[:7])
+    @staticmethod
     def maybeCallingOrWon(hand):
         if any(x[1] in '2345678' for x in hand.tileNames):
             return False
@@ -541,10 +580,9 @@ class AllPairHonors(Function):
     def shouldTry(hand, maxMissing=4):
         if hand.declaredMelds:
             return False
-        tiles = list(x.lower() for x in hand.tileNames)
         pairCount = kongCount = 0
         for tile in elements.majors:
-            count = tiles.count(tile)
+            count = hand.counts[TILEIDS[tile]]
             if count == 2:
                 pairCount += 1
             elif count == 4:
@@ -584,38 +622,45 @@ class FourfoldPlenty(Function):
         return len(hand.tileNames) == 18
 
 class ThreeGreatScholars(Function):
+    needSuits = 'd'
     def appliesToHand(self, hand):
         return (BigThreeDragons.appliesToHand(hand)
             and ('nochow' not in self.options or not any(x.isChow() for x in hand.melds)))
 
 class BigThreeDragons(Function):
+    needSuits = 'd'
     @staticmethod
     def appliesToHand(hand):
         return len([x for x in hand.dragonMelds if len(x) >= 3]) == 3
 
 class BigFourJoys(Function):
+    needSuits = 'w'
     @staticmethod
     def appliesToHand(hand):
         return len([x for x in hand.windMelds if len(x) >= 3]) == 4
 
 class LittleFourJoys(Function):
+    needSuits = 'w'
     @staticmethod
     def appliesToHand(hand):
         lengths = sorted([min(len(x), 3) for x in hand.windMelds])
         return lengths == [2, 3, 3, 3]
 
 class LittleThreeDragons(Function):
+    needSuits = 'd'
     @staticmethod
     def appliesToHand(hand):
         lengths = sorted([min(len(x), 3) for x in hand.dragonMelds])
         return lengths == [2, 3, 3]
 
 class FourBlessingsHoveringOverTheDoor(Function):
+    needSuits = 'w'
     @staticmethod
     def appliesToHand(hand):
         return len([x for x in hand.melds if len(x) >= 3 and x.pairs[0][0] in 'wW']) == 4
 
 class AllGreen(Function):
+    onlySuits = 'bd'
     @staticmethod
     def appliesToHand(hand):
         tiles = set(x.lower() for x in hand.tileNames)
@@ -666,7 +711,7 @@ class RobbingKong(Function):
         """for scoring game"""
         return (hand.lastSource and hand.lastSource in 'kwd'
             and hand.lastTile and hand.lastTile[0].islower()
-            and [x.lower() for x in hand.tileNames].count(hand.lastTile.lower()) < 2)
+            and hand.counts[TILEIDS[hand.lastTile]] < 2)
 
 class GatheringPlumBlossomFromRoof(Function):
     @staticmethod
@@ -694,8 +739,7 @@ class EastWonNineTimesInARow(Function):
     def appliesToHand(hand):
         if not hand.player:
             return False
-        game = hand.player.game
-        return EastWonNineTimesInARow.appliesToGame(game)
+        return hand.player.eastWonNineTimes()
     @staticmethod
     def appliesToGame(game, needWins=None):
         if needWins is None:
@@ -717,6 +761,9 @@ class EastWonNineTimesInARow(Function):
 
 
 class StandardMahJongg(Function):
+    suitTable = dict()
+    honorShapes = {0: {0: 0}, 2: {1: 0}, 3: {0: 0}}
+
     @staticmethod
     def computeLastMelds(hand):
         """returns all possible last melds"""
@@ -752,139 +799,107 @@ class StandardMahJongg(Function):
         return hand.score.doubles + doublingWinnerRules >= hand.ruleset.minMJDoubles
 
     @staticmethod
-    def fillChow(color, values):
-        val0, val1 = values
-        if val0 + 1 == val1:
-            if val0 == 1:
-                return set([color + str(val1 + 1)])
-            if val0 == 8:
-                return set([color + str(val0 - 1)])
-            return set([color + str(val0 - 1), color + str(val0 + 2)])
-        else:
-            assert val0 + 2 == val1, 'color:%s values:%s' % (color, values)
-            return set([color + str(val0 + 1)])
+    def suitShapes(counts):
+        """counts are the value counts of one suit. Returns a dict mapping the
+        number of pairs to the minimum number of chows over all complete
+        decompositions. The dict is empty if counts cannot be decomposed.
+        The table is filled for every suit pattern we meet."""
+        result = StandardMahJongg.suitTable.get(counts)
+        if result is None:
+            result = {}
+            for variant in SuitDecomposer.variants(counts):
+                pairs = sum(len(x) == 2 for x in variant)
+                chows = sum(x[0] != x[1] for x in variant)
+                if pairs not in result or chows < result[pairs]:
+                    result[pairs] = chows
+            StandardMahJongg.suitTable[counts] = result
+        return result
+
+    @staticmethod
+    def combineShapes(shapes):
+        """combine shapes of independent tile groups. Returns a dict mapping
+        the number of pairs (0 or 1) to the minimum number of chows"""
+        result = {0: 0}
+        for shape in shapes:
+            combined = {}
+            for pairs0, chows0 in result.items():
+                for pairs1, chows1 in shape.items():
+                    pairs = pairs0 + pairs1
+                    chows = chows0 + chows1
+                    if pairs < 2 and (pairs not in combined or chows < combined[pairs]):
+                        combined[pairs] = chows
+            result = combined
+        return result
 
     @staticmethod
     def winningTileCandidates(hand):
-        # pylint: disable=R0914,R0911,R0912,R0915
-        if len(hand.melds) > 7:
-            # hope 7 is sufficient, 6 was not
-            return set()
-        if not hand.tileNamesInHand:
+        """exactly those tiles completing the concealed tiles to sets and
+        one pair without exceeding maxChows. If the pair is already among
+        the declared melds, the concealed tiles must complete to sets only.
+        Looks up the decompositions for each suit pattern and each honor"""
+        if not hand.tileNamesInHand or 'Xy' in hand.tileNamesInHand:
             return set()
-        inHand = list(x.lower() for x in hand.tileNamesInHand)
-        result = inHand[:]
-        pairs = 0
-        isolated = 0
         maxChows = hand.ruleset.maxChows - sum(x.isChow() for x in hand.declaredMelds)
-        # TODO: does not differentiate between maxChows == 1 and maxChows > 1
-        # test with kajonggtest and a ruleset where maxChows == 2
         if maxChows < 0:
             return set()
-        if maxChows == 0:
-            checkTiles = set(inHand)
-        else:
-            checkTiles = set(inHand) & elements.honors
-        for tileName in checkTiles:
-            count = inHand.count(tileName)
-            if count % 4 == 1:
-                isolated += 1
-            elif count == 2:
-                pairs += 1
+        wantedPairs = 1 - sum(len(x) == 2 for x in hand.declaredMelds)
+        if wantedPairs < 0:
+            return set()
+        counts = tileCounts(hand.tileNamesInHand)
+        shapes = {}
+        for suit in 'sbc':
+            shapes[suit] = StandardMahJongg.suitShapes(suitCounts(counts, suit))
+        for tileIdx in range(HONORBASE, BONUSBASE):
+            shapes[tileIdx] = StandardMahJongg.honorShapes.get(counts[tileIdx], {})
+        brokenGroups = set(x for x in shapes if not shapes[x])
+        if len(brokenGroups) > 1:
+            # one tile can only repair one group
+            return set()
+        result = set()
+        for tileIdx in range(BONUSBASE):
+            if hand.counts[tileIdx] >= 4:
+                # we already see all four of them
+                continue
+            if tileIdx < HONORBASE:
+                group = 'sbc'[tileIdx // 9]
+                newCounts = list(suitCounts(counts, group))
+                newCounts[tileIdx % 9] += 1
+                newShape = StandardMahJongg.suitShapes(tuple(newCounts))
             else:
-                for _ in range(count):
-                    result.remove(tileName)
-        if maxChows:
-            if pairs > 2 or isolated > 2 or (pairs > 1 and isolated > 1):
-                # this is not a calling hand
-                return set()
-        else:
-            if pairs + isolated > 2:
-                return set()
-        if maxChows == 0:
-            return set(result)
-        melds = []
-        for color in hand.suits & set('sbc'):
-            values = sorted(int(x[1]) for x in result if x[0] == color)
-            changed = True
-            while (changed and len(values) > 2
-                    and values.count(values[0]) == 1
-                    and values.count(values[1]) == 1
-                    and values.count(values[2]) == 1):
-                changed = False
-                if values[0] + 2 == values[2] and (len(values) == 3 or values[3] > values[0] + 3):
-                    # print('removing first 3 from %s' % values)
-                    meld = Meld([color + str(values[x]) for x in range(3)])
-                    for pair in meld.pairs:
-                        result.remove(pair)
-                    melds.append(meld)
-                    values = values[3:]
-                    changed = True
-                elif values[0] + 1 == values[1] and values[2] > values[0] + 2:
-                    # print('found incomplete chow at start of %s' % values)
-                    return StandardMahJongg.fillChow(color, values[:2])
-            changed = True
-            while (changed and len(values) > 2
-                    and values.count(values[-1]) == 1
-                    and values.count(values[-2]) == 1
-                    and values.count(values[-3]) == 1):
-                changed = False
-                if values[-1] - 2 == values[-3] and (len(values) == 3 or values[-4] < values[-1] - 3):
-                    # print('removing last 3 from %s' % values)
-                    meld = Meld([color + str(values[x]) for x in range(-3, 0)])
-                    for pair in meld.pairs:
-                        result.remove(pair)
-                    melds.append(meld)
-                    values = values[:-3]
-                    changed = True
-                elif values[-1] - 1 == values[-2] and values[-3] < values[-1] - 2:
-                    # print('found incomplete chow at end of %s' % values)
-                    return StandardMahJongg.fillChow(color, values[-2:])
-
-            if len(values) % 3 == 0:
-                # adding a 4th, 7th or 10th tile with this color can not let us win,
-                # so we can exclude this color from the candidates
-                result = list(x for x in result if x[0] != color)
+                group = tileIdx
+                newShape = StandardMahJongg.honorShapes.get(counts[tileIdx] + 1)
+            if not newShape or brokenGroups - set([group]):
                 continue
-            valueSet = set(values)
-            if len(values) == 4 and len(values) == len(valueSet):
-                if values[0] + 3 == values[-1]:
-                    # print('seq4 in %s' % hand.tileNamesInHand)
-                    return set([color + str(values[0]), color + str(values[-1])])
-            if len(values) == 7 and len(values) == len(valueSet):
-                if values[0] + 6 == values[6]:
-                    # print('seq7 in %s' % hand.tileNamesInHand)
-                    return set([color + str(values[0]), color + str(values[3]), color + str(values[6])])
-            if len(values) == 1:
-                # only a pair of this value is possible
-                return set([color.upper() + str(values[0])])
-            if len(valueSet) == 1:
-                # no chow reachable, only pair/pung
+            combined = StandardMahJongg.combineShapes(
+                [newShape] + list(shapes[x] for x in shapes if x != group))
+            if wantedPairs in combined and combined[wantedPairs] <= maxChows:
+                result.add(tileName(tileIdx))
+        return result
+
+    @staticmethod
+    def missingTiles(hand, counts):
+        """how many tiles are missing for a standard mah jongg. counts are
+        the concealed tiles. Every set still wanted needs two tiles, one if
+        we have a partial set. The pair needs one tile unless it is declared.
+        Returns None if no standard mah jongg is possible"""
+        setsWanted = 4 - sum(len(x) > 2 for x in hand.declaredMelds)
+        maxChows = hand.ruleset.maxChows - sum(x.isChow() for x in hand.declaredMelds)
+        declaredHeads = sum(len(x) == 2 for x in hand.declaredMelds)
+        if setsWanted < 0 or maxChows < 0 or declaredHeads > 1:
+            return None
+        groups = [suitCounts(counts, x) for x in 'sbc']
+        groups.extend((counts[x],) for x in range(HONORBASE, BONUSBASE))
+        combined = set([(0, 0, declaredHeads, 0)])
+        for group in groups:
+            if not any(group):
                 continue
-            singles = set(x for x in valueSet
-                 if values.count(x) == 1
-                 and not set([x-1, x-2, x+1, x+2]) & valueSet)
-            isolated += len(singles)
-            if isolated > 1:
-                # this is not a calling hand
-                return set()
-            if len(values) == 2 and len(valueSet) == 2:
-                # exactly two adjacent values: must be completed to Chow
-                if maxChows == 0:
-                    # not a calling hand
-                    return set()
-                return StandardMahJongg.fillChow(color, values)
-            if (len(values) == 4 and len(valueSet) == 2
-                    and values[0] == values[1] and values[2] == values[3]):
-                # print('we have 2 pairs of %s' % color)
-                return set([color + str(values[0]), color + str(values[2])])
-            if maxChows:
-                for value in valueSet:
-                    if value > 1:
-                        result.append(color + str(value - 1))
-                    if value < 9:
-                        result.append(color + str(value + 1))
-        return set(result)
+            combined = set((sets0 + sets1, partials0 + partials1, heads0 + heads1, chows0 + chows1)
+                for sets0, partials0, heads0, chows0 in combined
+                for sets1, partials1, heads1, chows1 in SuitDecomposer.partials(group)
+                if sets0 + sets1 + partials0 + partials1 <= setsWanted
+                and heads0 + heads1 < 2 and chows0 + chows1 <= maxChows)
+        return min(2 * (setsWanted - sets) - partials - heads + 1
+            for sets, partials, heads, _ in combined)
 
     @staticmethod
     def shouldTry(dummyHand):
@@ -923,18 +938,18 @@ class StandardMahJongg(Function):
         return bestVariant, []
 
 class GatesOfHeaven(Function):
-    def __init__(self):
-        Function.__init__(self)
-        self.suit = None
-    def maybeCallingOrWon(self, hand):
+    onlySuits = 'sbc'
+    maxSuits = 1
+    @staticmethod
+    def maybeCallingOrWon(hand):
+        """returns the suit if hand might be calling or won"""
         suits = set(x[0].lower() for x in hand.tileNames)
         if len(suits) != 1 or not suits < set('sbc'):
-            return False
-        self.suit = suits.pop()
+            return None
         for meld in hand.declaredMelds:
             if meld.isPung():
-                return False
-        return True
+                return None
+        return suits.pop()
 
     def appliesToHand(self, hand):
         if not self.maybeCallingOrWon(hand):
@@ -956,7 +971,8 @@ class GatesOfHeaven(Function):
 
     def winningTileCandidates(self, hand):
         result = set()
-        if not self.maybeCallingOrWon(hand):
+        suit = self.maybeCallingOrWon(hand)
+        if not suit:
             return result
         values = hand.values
         if len(set(values)) == 8:
@@ -973,12 +989,10 @@ class GatesOfHeaven(Function):
                     result = set('2345678')
                 else:
                     result = set('123456789')
-        return set(self.suit + x for x in result)
+        return set(suit + x for x in result)
 
 class ThirteenOrphans(Function):
-    def __init__(self):
-        Function.__init__(self)
-        self.missingTiles = None
+    needSuits = 'sbcwd'
 
     @staticmethod
     def computeLastMelds(hand):
@@ -1019,6 +1033,14 @@ class ThirteenOrphans(Function):
     def appliesToHand(hand):
         return set(x.lower() for x in hand.tileNames) == elements.majors
 
+    @staticmethod
+    def missingTiles(hand, counts):
+        """all 13 majors and one more of them"""
+        if hand.declaredMelds:
+            return None
+        majorCounts = list(counts[TILEIDS[x]] for x in elements.majors)
+        return 14 - sum(bool(x) for x in majorCounts) - any(x > 1 for x in majorCounts)
+
     @staticmethod
     def winningTileCandidates(hand):
         if any(x in hand.values for x in '2345678'):
@@ -1026,8 +1048,7 @@ class ThirteenOrphans(Function):
             return set()
         if not ThirteenOrphans.shouldTry(hand, maxMissing=1):
             return set()
-        handTiles = set(x.lower() for x in hand.tileNames)
-        missing = elements.majors - handTiles
+        missing = set(x for x in elements.majors if not hand.counts[TILEIDS[x]])
         if len(missing) == 0:
             # if all 13 tiles are there, we need any one of them:
             return elements.majors
@@ -1195,18 +1216,18 @@ class LastOnlyPossible(Function):
 
     def __init__(self):
         Function.__init__(self)
-        self.active = False
+        self.active = threading.local() # the server evaluates in threads
 
     def appliesToHand(self, hand):
-        if self.active or not hand.lastTile:
+        if getattr(self.active, 'value', False) or not hand.lastTile:
             return False
         shortHand = hand - hand.lastTile
-        self.active = True
+        self.active.value = True
         try:
             otherCallingHands = shortHand.callingHands(excludeTile=hand.lastTile)
             return len(otherCallingHands) == 0
         finally:
-            self.active = False
+            self.active.value = False
 
 def __scanSelf():
     """for every Function class defined in this module,
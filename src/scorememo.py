@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Copyright (C) 2009-2012 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+
+A persistent memo for hand evaluations. Scoring a hand string with a
+given ruleset always gives the same result, so we can remember it across
+processes. The memo lives in its own sqlite3 file next to the data base
+and is only used for hands evaluated by a Ruleset: hands evaluated for a
+player may also look at the game state. This is why the server does not
+use it: it only evaluates hands of players. Hand.cached does not either:
+it must return Hand instances, and the memo only knows the results.
+scoringtest.py --memo passes one to scoreMany.
+
+Run this module for scoring many hand strings from stdin, one per line:
+    scorememo.py [--ruleset NAME] [--processes N] [--memo PATH] < hands
+"""
+
+import os, sys
+import sqlite3
+from hashlib import md5 # pylint: disable=E0611
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from hand import Hand
+from rule import Ruleset, PredefinedRuleset
+from query import DBHandle
+from util import logDebug, initLog
+from common import Debug, Internal
+
+class MemoizedScore(object):
+    """the essential results of a hand evaluation"""
+    # pylint: disable=R0913
+    def __init__(self, total, points, doubles, limits, won, usedRules, melds):
+        self.total = total
+        self.points = points
+        self.doubles = doubles
+        self.limits = limits
+        self.won = won
+        self.usedRules = usedRules
+        self.melds = melds
+
+    @staticmethod
+    def fromHand(hand):
+        """extract what we want to remember"""
+        score = hand.score
+        return MemoizedScore(hand.total(), score.points, score.doubles, score.limits,
+            hand.won, tuple(x.rule.name for x in hand.usedRules),
+            tuple(x.joined for x in hand.melds))
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return '%d%s %s' % (self.total, ' won' if self.won else '', ','.join(self.usedRules))
+
+    def __repr__(self):
+        return 'MemoizedScore(%s)' % str(self)
+
+class ScoreMemo(object):
+    """maps ruleset, scoring code and canonical hand key to a MemoizedScore"""
+
+    __codeVersion = None
+
+    schema = """
+        ruleset text,
+        hand text,
+        total integer,
+        points integer,
+        doubles integer,
+        limits real,
+        won integer,
+        rules text,
+        melds text,
+        primary key(ruleset,hand)"""
+
+    def __init__(self, path=None):
+        self.path = path or ScoreMemo.defaultPath()
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('create table if not exists score(%s)' % self.schema)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def defaultPath():
+        """next to the data base: kajongg.db has kajongg-scores.db"""
+        return '%s-scores.db' % os.path.splitext(DBHandle.dbPath())[0]
+
+    @staticmethod
+    def codeVersion():
+        """a hash over the kajongg version and the source of the scoring code.
+        Results remembered by other code are never found"""
+        if ScoreMemo.__codeVersion is None:
+            result = md5(Internal.version)
+            for moduleName in ('rulecode', 'meld', 'rule', 'hand'):
+                path = __import__(moduleName).__file__
+                if path.endswith('.pyc') and os.path.exists(path[:-1]):
+                    path = path[:-1]
+                with open(path, 'rb') as sourceFile:
+                    result.update(sourceFile.read())
+            ScoreMemo.__codeVersion = result.hexdigest()
+        return ScoreMemo.__codeVersion
+
+    @staticmethod
+    def key(ruleset, string, computedRules=None, robbedTile=None):
+        """the ruleset key and the canonical hand key as strings. The ruleset key
+        also holds the parameters of the ruleset and the version of the scoring code"""
+        _, ((rulesetHash, parameters), melds, mjStr, robbedTile, cRuleNames, owner) = Hand.cacheKey(
+            ruleset, string, computedRules, robbedTile)
+        assert owner is None, 'ScoreMemo only knows hands evaluated by a Ruleset'
+        rulesetKey = '%s/%s/%s' % (rulesetHash, md5(repr(parameters)).hexdigest(), ScoreMemo.codeVersion())
+        return rulesetKey, '|'.join([melds, mjStr, robbedTile or '', '&&'.join(cRuleNames)])
+
+    def lookup(self, ruleset, string, computedRules=None, robbedTile=None):
+        """returns a MemoizedScore or None"""
+        rulesetKey, handKey = self.key(ruleset, string, computedRules, robbedTile)
+        record = self.connection.execute(
+            'select total,points,doubles,limits,won,rules,melds from score where ruleset=? and hand=?',
+            (rulesetKey, handKey)).fetchone()
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        total, points, doubles, limits, won, rules, melds = record
+        return MemoizedScore(total, points, doubles, limits, bool(won),
+            tuple(rules.split('&&')) if rules else (), tuple(melds.split()))
+
+    def store(self, hand, string=None):
+        """remember the evaluation of hand. Pass the original string if the hand
+        was built from it, Hand may have changed hand.string"""
+        return self.remember(hand.ruleset, string or hand.string, MemoizedScore.fromHand(hand),
+            hand.computedRules, hand.robbedTile)
+
+    def remember(self, ruleset, string, memo, computedRules=None, robbedTile=None):
+        """remember a MemoizedScore computed elsewhere, like in another process"""
+        rulesetKey, handKey = self.key(ruleset, string, computedRules, robbedTile)
+        self.connection.execute('insert or replace into score values(?,?,?,?,?,?,?,?,?)',
+            (rulesetKey, handKey, memo.total, memo.points, memo.doubles, memo.limits,
+            int(memo.won), '&&'.join(memo.usedRules), ' '.join(memo.melds)))
+        return memo
+
+    def score(self, ruleset, string, computedRules=None, robbedTile=None):
+        """returns a MemoizedScore, evaluating the hand only if it is not yet known"""
+        result = self.lookup(ruleset, string, computedRules, robbedTile)
+        if result is None:
+            result = self.store(Hand.cached(ruleset, string, computedRules, robbedTile), string)
+        return result
+
+    def commit(self):
+        """write pending evaluations to disk"""
+        if Debug.handCache:
+            logDebug('score memo %s: hits:%d misses:%d' % (self.path, self.hits, self.misses))
+        self.connection.commit()
+
+    def close(self):
+        """commit and close the file"""
+        self.commit()
+        self.connection.close()
+
+# the ruleset used by a scoreMany worker process
+_WORKERRULESET = None
+
+def _initWorker(rulesetList, parameters):
+    """rebuild the ruleset in a worker process like a client does
+    with a ruleset sent by the server"""
+    global _WORKERRULESET # pylint: disable=W0603
+    _WORKERRULESET = Ruleset(rulesetList)
+    _WORKERRULESET.__dict__.update(parameters)
+
+def _scoreInWorker(string):
+    """evaluate one hand in a worker process"""
+    return MemoizedScore.fromHand(Hand.cached(_WORKERRULESET, string))
+
+def scoreMany(ruleset, strings, processes=None, memo=None):
+    """evaluate many hand strings with the same ruleset. Returns a list
+    of MemoizedScore in the order of strings. Identical strings are
+    evaluated only once. With processes > 1 the evaluation is distributed
+    to a pool of worker processes. If memo is a ScoreMemo, it is asked
+    first and it learns all new results"""
+    ruleset.load()
+    results = OrderedDict.fromkeys(strings)
+    if memo:
+        for string in results:
+            results[string] = memo.lookup(ruleset, string)
+    todo = list(x for x in results if results[x] is None)
+    if processes > 1 and len(todo) > 1:
+        parameters = dict((x.parName, ruleset.__dict__[x.parName]) for x in ruleset.parameterRules)
+        pool = Pool(processes, _initWorker, (ruleset.toList(), parameters))
+        try:
+            computed = pool.map(_scoreInWorker, todo, max(1, len(todo) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        computed = list(MemoizedScore.fromHand(Hand.cached(ruleset, x)) for x in todo)
+    for string, score in zip(todo, computed):
+        results[string] = score
+        if memo:
+            memo.remember(ruleset, string, score)
+    return list(results[x] for x in strings)
+
+def main():
+    """score the hand strings from stdin with a predefined ruleset"""
+    from optparse import OptionParser
+    import predefined # pylint: disable=W0612
+    # predefined registers the predefined rulesets
+    parser = OptionParser(usage='%prog [options] < hands')
+    parser.add_option('', '--ruleset', dest='ruleset',
+        help='the name of a predefined ruleset. Default is the first one')
+    parser.add_option('', '--processes', dest='processes', type=int, default=1,
+        help='evaluate with PROCESSES processes')
+    parser.add_option('', '--memo', dest='memo',
+        help='remember the scores in the sqlite3 file MEMO')
+    options, args = parser.parse_args()
+    if args:
+        print 'unrecognized arguments:', ' '.join(args)
+        sys.exit(2)
+    rulesets = PredefinedRuleset.rulesets()
+    if options.ruleset:
+        rulesets = list(x for x in rulesets if x.name == options.ruleset)
+        if not rulesets:
+            print 'unknown ruleset:', options.ruleset
+            sys.exit(2)
+    strings = list(x.strip() for x in sys.stdin if x.strip())
+    memo = ScoreMemo(options.memo) if options.memo else None
+    try:
+        for string, score in zip(strings, scoreMany(rulesets[0], strings, options.processes, memo)):
+            print '%s: %s' % (string, score)
+    finally:
+        if memo:
+            memo.close()
+
+if __name__ == '__main__':
+    initLog('kajongg')
+    main()
@@ -19,10 +19,21 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
+import os, sys, shutil, tempfile
 import unittest
-from hand import Hand, Score
+from random import Random
+from itertools import count
+from hand import Hand, HandCache, Score
+from scorememo import ScoreMemo, MemoizedScore, scoreMany
 from predefined import ClassicalChineseDMJL, ClassicalChineseBMJA
-from common import Debug
+from common import Debug, WINDS
+from altint import AIMonteCarlo
+from intelligence import AIDefault, AIRegistry, findAI
+from player import Player, PlayerSnapshot
+from client import Client
+from move import Move
+from message import Message
+from tile import Tile, TileCounter
 from util import initLog
 
 RULESETS = []
@@ -37,6 +48,49 @@ for _ in RULESETS[2:]:
     _.roofOff = True
 
 PROGRAM = None
+MEMO = None # a ScoreMemo, see --memo
+
+class TestGame(object):
+    """a game without server, data base or display, providing just what
+    Player, Hand and the AI need. It is also the client of the AI.
+    The player sitting East is myself"""
+    serials = count(1)
+
+    def __init__(self, ruleset, seed=0):
+        self.ruleset = ruleset
+        self.seed = seed
+        self.serial = next(TestGame.serials)
+        self.randomGenerator = Random(seed)
+        self.visibleTiles = TileCounter()
+        self.roundsFinished = 0
+        self.winner = None
+        self.players = []
+        for wind in WINDS:
+            player = Player(self)
+            player.name = 'Tester' + wind
+            player.wind = wind
+            self.players.append(player)
+        self.myself = self.players[0]
+
+    @property
+    def game(self):
+        """for the AI, we are also the client"""
+        return self
+
+    @staticmethod
+    def isScoringGame():
+        """we play"""
+        return False
+
+    @staticmethod
+    def isDangerousFor(dummyPlayer, dummyTileName):
+        """nothing is dangerous here"""
+        return False
+
+    @staticmethod
+    def debug(dummyMsg, btIndent=None):
+        """the tests check results, not the log"""
+        pass
 
 class Regex(unittest.TestCase):
     """tests lots of hand examples. We might want to add comments which test should test which rule"""
@@ -404,14 +458,11 @@ class Regex(unittest.TestCase):
     def scoreTest(self, string, expected, totals=None):
         """execute one scoreTest test"""
         for idx, ruleset in enumerate(RULESETS):
-            variants = []
-            variant = Hand(ruleset, string)
-            variants.append(variant)
-            score = variant.score
+            result = scoreMany(ruleset, [string], memo=MEMO)[0]
+            score = Score(result.points, result.doubles, result.limits, ruleset)
 # activate depending on what you are testing
-#            kprint(string, 'expected:', expected.__str__()), variant
+#            kprint(string, 'expected:', expected.__str__()), result
 #            kprint(ruleset.name.encode('utf-8'))
-#            kprint('\n'.join(variant.explain).encode('ut-f8'))
             if isinstance(expected, list):
                 expIdx = idx
                 if expIdx >= len(expected):
@@ -420,9 +471,11 @@ class Regex(unittest.TestCase):
             else:
                 exp = expected
             exp.ruleset = ruleset
-            self.assert_(score == exp, self.dumpCase(variants, exp, total=None))
-            if totals:
-                self.assert_(score.total() == totals[idx], self.dumpCase(variants, exp, totals[idx]))
+            if score != exp or (totals and result.total != totals[idx]):
+                # only build the full hand for explaining the failure
+                variants = [Hand(ruleset, string)]
+                self.assert_(score == exp, self.dumpCase(variants, exp, total=None))
+                self.assert_(result.total == totals[idx], self.dumpCase(variants, exp, totals[idx]))
 
     def dumpCase(self, variants, expected, total):
         """dump test case"""
@@ -447,6 +500,193 @@ class Regex(unittest.TestCase):
             result.append('')
         return '\n'.join(result).encode('ascii', 'ignore')
 
+class AITest(unittest.TestCase):
+    """the robot AI variants"""
+
+    def testMonteCarloReplay(self):
+        """the same seed must give the same decision"""
+        hand = Hand(RULESETS[0], 'RS1S2S4S7B2B3B5C3C9WeWsDrDb mwe')
+        decisions = []
+        for _ in range(2):
+            game = TestGame(RULESETS[0], 4711)
+            aiInstance = AIMonteCarlo(game)
+            candidates = aiInstance.candidates.prepare(game, hand)
+            AIMonteCarlo.alternativeFilter(aiInstance, candidates)
+            decisions.append((list((x.name, x.keep) for x in candidates), candidates.best()))
+            candidates.release()
+        self.assert_(decisions[0] == decisions[1], decisions)
+
+    def testAIRegistry(self):
+        """AI variants are found by name, also those in a directory"""
+        class AITestOnly(AIDefault):
+            """registered by this test"""
+            pass
+        AIRegistry.register(AITestOnly)
+        self.assert_(findAI('TestOnly') is AITestOnly)
+        self.assert_(findAI('MonteCarlo') is AIMonteCarlo)
+        self.assert_(findAI('NoSuchAI') is None)
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'testai.py'), 'w') as aiFile:
+                aiFile.write('from intelligence import AIDefault\nclass AIFromFile(AIDefault):\n    pass\n')
+            AIRegistry.loadDirectory(path)
+        finally:
+            shutil.rmtree(path)
+        self.assert_(findAI('FromFile').__name__ == 'AIFromFile')
+        self.assert_('FromFile' in AIRegistry.names())
+
+class ScoreHashTest(unittest.TestCase):
+    """the server only sends a hash of the score strings"""
+
+    def testScoreHash(self):
+        """equal hands have equal score hashes. If the hash from the
+        server differs, the client asks for the score string"""
+        string = 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1'
+        hand = Hand(RULESETS[0], string)
+        other = Hand(RULESETS[0], string.replace('wewewe', 'wnwnwn'))
+        self.assert_(Hand.scoreHash(str(hand)) == Hand.scoreHash(str(Hand(RULESETS[0], string))))
+        self.assert_(Hand.scoreHash(str(hand)) != Hand.scoreHash(str(other)))
+        game = TestGame(RULESETS[0])
+        player = game.myself
+        player.addConcealedTiles(list(Tile(x) for x in 'S1 S1 S1 B9 B9 B9 C1 C1 C1 C2 C3 We We'.split()))
+        client = Client()
+        asked = []
+        client.askServerScore = asked.append
+        move = Move(player, Message.Discard, dict(token=0, scoreHash=Hand.scoreHash(str(player.hand))))
+        self.assert_(client.scoreMatches(move) and not asked)
+        move = Move(player, Message.Discard, dict(token=0, scoreHash=Hand.scoreHash(str(other))))
+        self.assert_(not client.scoreMatches(move) and asked == [player.name])
+
+class HandCacheTest(unittest.TestCase):
+    """the cache for Hand instances"""
+
+    def testHandCache(self):
+        """clearing the partition of one game must not touch other partitions"""
+        cache = HandCache()
+        cache.maxEntries = 2
+        for partition in (1, 2):
+            for key in 'abc':
+                cache.put(partition, key, key.upper())
+        self.assert_(cache.evictions == 2 and len(cache) == 4)
+        self.assertRaises(KeyError, cache.get, 1, 'a')
+        cache.clear(1)
+        self.assert_(cache.get(2, 'c') == 'C' and len(cache) == 2)
+
+    def testCacheKey(self):
+        """the cache key must not depend on the order of melds or on object identity"""
+        ruleset = RULESETS[0]
+        key1 = Hand.cacheKey(ruleset, 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1')
+        key2 = Hand.cacheKey(ruleset, 'b9b9b9 s1s1s1 wewewe RC1C1C1C2C3 Mee LC1')
+        self.assert_(key1 == key2)
+        self.assert_(key1 != Hand.cacheKey(RULESETS[1], 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1'))
+        self.assert_(key1 != Hand.cacheKey(RULESETS[2], 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1'))
+        self.assert_(key1 != Hand.cacheKey(ruleset, 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC2'))
+
+    def testCachedOrder(self):
+        """a cache hit for melds in another order must keep the order we asked for"""
+        ruleset = RULESETS[0]
+        for string in ('wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1', 'b9b9b9 s1s1s1 wewewe RC1C1C1C2C3 Mee LC1',
+                'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 mee', 'b9b9b9 s1s1s1 wewewe RC1C1C1C2C3 mee'):
+            hand = Hand.cached(ruleset, string)
+            self.assert_(hand.string == string, '%s != %s' % (hand.string, string))
+            self.assert_(hand.total() == Hand(ruleset, string).total())
+
+class StandardMahJonggTest(unittest.TestCase):
+    """the counting helpers of StandardMahJongg"""
+
+    def testWinningTileCandidates(self):
+        """the pair may be a declared meld"""
+        for ruleset in RULESETS:
+            stdRule = [x for x in ruleset.mjRules if x.function.__class__.__name__ == 'StandardMahJongg'][0]
+            for string in ('b8b8 RS1S1S1S2S2S2B2B2B2C1C2 mwe', 'RS1S1S1S2S2S2B2B2B2C1C2B8B8 mwe'):
+                self.assert_(stdRule.function.winningTileCandidates(Hand(ruleset, string)) == set(['c3']))
+            hand = Hand(ruleset, 'dgdgdg RDrDrDrDbDb s4s4s4 c5c5 msw')
+            self.assert_(stdRule.function.winningTileCandidates(hand) == set(['db']))
+
+    def testTilesToWin(self):
+        """missing tiles for standard mah jongg"""
+        for ruleset in RULESETS:
+            stdRule = [x for x in ruleset.mjRules if x.function.__class__.__name__ == 'StandardMahJongg'][0]
+            if ruleset.maxChows > 2:
+                hand = Hand(ruleset, 'RS1S1S1S2S3S4S5S6S7S8S9S9S9 mwe')
+                self.assert_(hand.tilesToWin()[stdRule] == (1, set('s%d' % x for x in range(1, 10))))
+            for string in ('RS1S1S1B2B2B2C3C3C3WeWeWeDr mwe', 'c5c5 RS1S1S1B2B2B2C3C3C3DrDr mwe'):
+                self.assert_(Hand(ruleset, string).tilesToWin()[stdRule] == (1, set(['dr'])))
+            hand = Hand(ruleset, 'RS1S4S7B2B5B8C3C6C9WeWsWwDr mwe')
+            self.assert_(hand.tilesToWin()[stdRule][0] == 9)
+
+class PlayerSnapshotTest(unittest.TestCase):
+    """the server evaluates hands in threads"""
+
+    def testSnapshot(self):
+        """the snapshot does not see later changes of the game"""
+        game = TestGame(RULESETS[0])
+        player = game.myself
+        string = 's1s1s1s1 b5b6b7 RB8B8C2C2C6C7C8 mwe Lb5'
+        game.visibleTiles['b8'] += 2 # the others exposed the other b8
+        snapshot = PlayerSnapshot(player)
+        game.visibleTiles['c2'] += 2 # and later the other c2
+        completedHands = Hand.cached(snapshot, string).callingHands(99, mustBeAvailable=True)
+        self.assert_([x.lastTile for x in completedHands] == ['C2'])
+        self.assert_(not Hand.cached(player, string).callingHands(99, mustBeAvailable=True))
+
+class ScoreMemoTest(unittest.TestCase):
+    """the persistent score memo"""
+
+    def testScoreMemo(self):
+        """the persistent memo must return what Hand computes"""
+        memo = ScoreMemo(':memory:')
+        string = 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1'
+        # RULESETS[2:] only differ by roofOff, so they must get their own keys
+        self.assert_(len(set(ScoreMemo.key(x, string) for x in RULESETS)) == len(RULESETS))
+        for ruleset in RULESETS:
+            self.assert_(memo.lookup(ruleset, string) is None)
+            expected = MemoizedScore.fromHand(Hand(ruleset, string))
+            self.assert_(memo.score(ruleset, string) == expected)
+            self.assert_(memo.lookup(ruleset, string) == expected)
+        memo.close()
+
+    def testMemoFile(self):
+        """the file is reused by the next ScoreMemo. A new version of the
+        scoring code or another ruleset do not find old results"""
+        string = 'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1'
+        path = tempfile.mkdtemp()
+        try:
+            memo = ScoreMemo(os.path.join(path, 'scores.db'))
+            expected = memo.score(RULESETS[0], string)
+            memo.close()
+            memo = ScoreMemo(os.path.join(path, 'scores.db'))
+            self.assert_(memo.lookup(RULESETS[0], string) == expected and memo.hits == 1)
+            self.assert_(memo.lookup(RULESETS[1], string) is None)
+            self.assert_(memo.lookup(RULESETS[2], string) is None)
+            codeVersion = ScoreMemo.codeVersion()
+            ScoreMemo._ScoreMemo__codeVersion = 'older' # pylint: disable=W0212
+            try:
+                self.assert_(memo.lookup(RULESETS[0], string) is None)
+            finally:
+                ScoreMemo._ScoreMemo__codeVersion = codeVersion # pylint: disable=W0212
+            memo.close()
+        finally:
+            shutil.rmtree(path)
+
+    def testScoreMany(self):
+        """batch evaluation gives the same results as single hands"""
+        strings = [r'c1c2c3 c7c8c9 b2b3b4 c5c5 s1s2s3 fw yw Mwn Lc1c1c2c3',
+            r'fe mes', r'c1c2c3 c7c8c9 b2b3b4 c5c5 s1s2s3 fw yw Mwn Lc1c1c2c3']
+        for ruleset in RULESETS:
+            results = scoreMany(ruleset, strings)
+            self.assertEqual(len(results), 3)
+            self.assert_(results[0] is results[2])
+            for string, result in zip(strings, results):
+                self.assertEqual(result, MemoizedScore.fromHand(Hand(ruleset, string)))
+
+    def testScoreManyInProcesses(self):
+        """the process pool gives the same results as one process"""
+        strings = [r'c1c2c3 c7c8c9 b2b3b4 c5c5 s1s2s3 fw yw Mwn Lc1c1c2c3', r'fe mes',
+            r'wewewe s1s1s1 b9b9b9 RC1C1C1C2C3 Mee LC1', r'RB1B1B1B2B2B2B3B4 wnwnwn wewewe Mee Lwnwnwnwn']
+        for ruleset in RULESETS:
+            self.assertEqual(scoreMany(ruleset, strings, processes=2), scoreMany(ruleset, strings))
+
 class TstProgram(unittest.TestProgram):
     """we want global access to this program so we can check for verbosity in our tests"""
     def __init__(self, *args, **kwargs):
@@ -458,4 +698,13 @@ if __name__ == '__main__':
     initLog('kajonggtest')
     Debug.profileRegex = True
    # Debug.handMatch = True
-    TstProgram()
+    # --memo[=PATH]: remember the scores in a ScoreMemo for the next run
+    for arg in sys.argv[1:]:
+        if arg == '--memo' or arg.startswith('--memo='):
+            sys.argv.remove(arg)
+            MEMO = ScoreMemo(arg[len('--memo='):] or None)
+    try:
+        TstProgram()
+    finally:
+        if MEMO:
+            MEMO.close()
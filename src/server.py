@@ -26,7 +26,6 @@ O'Reilly Media, Inc., ISBN 0-596-10032-9
 import sys, os, random, traceback
 import signal
 import resource
-import datetime
 
 # keyboardinterrupt should simply terminate
 signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -40,13 +39,15 @@ initLog('kajonggserver')
 from PyQt4.QtCore import QCoreApplication
 from twisted.spread import pb
 from twisted.internet import error
-from twisted.internet.defer import maybeDeferred, fail, succeed
+from twisted.internet.defer import Deferred, maybeDeferred, fail, succeed
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 from zope.interface import implements
 from twisted.cred import checkers, portal, credentials, error as credError
 from twisted.internet import reactor
 
 from game import RemoteGame
-from player import Players
+from player import Players, PlayerSnapshot
 from wall import WallEmpty
 from client import Client, Table
 from query import Transaction, Query, DBHandle, initDb
@@ -58,6 +59,7 @@ from common import elements, Debug
 from sound import Voice
 from deferredutil import DeferredBlock
 from rule import Ruleset
+from hand import Hand
 
 def srvMessage(*args):
     """concatenate all args needed for m18n encoded in one string.
@@ -140,6 +142,7 @@ class ServerTable(Table):
         self.users = [owner] if owner else []
         self.remotes = {}   # maps client connections to users
         self.game = None
+        self.scoreStrings = {} # the last score string sent for each player
         server.tables[self.tableid] = self
 
     def hasName(self, name):
@@ -343,14 +346,20 @@ class ServerTable(Table):
             self.game.gameid = gameid
             self.initGame()
 
+    def allRobots(self):
+        """True if no human will ever answer: all players are robots or the
+        owner is the only human and lets the computer play for him"""
+        return all(x is self.owner for x in self.users) and (self.autoPlay or not self.users)
+
     def initGame(self):
         """ask clients if they are ready to start"""
         game = self.game
         game.saveNewGame()
+        game.fastForward = self.allRobots()
         block = DeferredBlock(self)
         for player in game.players:
             block.tellPlayer(player, Message.ReadyForGameStart, tableid=self.tableid,
-                gameid=game.gameid, shouldSave=player.shouldSave,
+                gameid=game.gameid, shouldSave=player.shouldSave, fastForward=game.fastForward,
                 wantedGame=game.wantedGame, source=list((x.wind, x.name) for x in game.players))
         block.callback(self.startGame)
 
@@ -496,21 +505,44 @@ class ServerTable(Table):
         if tile not in player.concealedTileNames:
             self.abort('player %s discarded %s but does not have it' % (player, tile))
             return
-        txt = game.dangerousFor(player, tile)
+        dangerous = game.isDangerousFor(player, tile)
+        txt = game.dangerousFor(player, tile) if dangerous and Debug.dangerousGame else []
         mustPlayDangerous = player.mustPlayDangerous()
-        block = DeferredBlock(self)
         game.hasDiscarded(player, tile)
-        block.tellAll(player, Message.Discard, tile=tile)
-        if player.violatesOriginalCall():
+        violates = player.violatesOriginalCall()
+        if violates:
             if Debug.originalCall:
                 logDebug('%s just violated OC with %s' % (player, player.discarded[-1]))
             player.mayWin = False
-            block.tellAll(player, Message.ViolatesOriginalCall)
         if game.ruleset.mustDeclareCallingHand and not player.isCalling:
-            if player.hand.callingHands(mustBeAvailable=True):
-                player.isCalling = True
-                block.tellAll(player, Message.Calling)
-        if txt:
+            isCalling = self.server.compute(self.__isCalling, PlayerSnapshot(player), player.handString())
+        else:
+            isCalling = succeed(False)
+        isCalling.addCallback(self.__discardedCalling, msg, violates, dangerous, mustPlayDangerous, txt).addErrback(
+            self.computeFailed)
+
+    @staticmethod
+    def __isCalling(snapshot, string):
+        """does the player have a calling hand? This may take a while.
+        This runs in a thread, so it gets a PlayerSnapshot"""
+        return bool(Hand.cached(snapshot, string).callingHands(mustBeAvailable=True))
+
+    def __discardedCalling(self, isCalling, msg, violates, dangerous, mustPlayDangerous, txt):
+        """continue clientDiscarded after we know if player is calling"""
+        # pylint: disable=R0913
+        # too many arguments
+        if not self.running:
+            return
+        player = msg.player
+        tile = msg.args[0]
+        block = DeferredBlock(self)
+        block.tellAll(player, Message.Discard, tile=tile)
+        if violates:
+            block.tellAll(player, Message.ViolatesOriginalCall)
+        if isCalling:
+            player.isCalling = True
+            block.tellAll(player, Message.Calling)
+        if dangerous:
             if mustPlayDangerous and player.lastSource not in 'dZ':
                 if Debug.dangerousGame:
                     logDebug('%s claims no choice. Discarded %s, keeping %s. %s' % \
@@ -643,7 +675,7 @@ class ServerTable(Table):
         self.game.lastDiscard = None
         block = DeferredBlock(self)
         if (nextMessage != Message.Kong
-                and self.game.dangerousFor(discardingPlayer, lastDiscard)
+                and self.game.isDangerousFor(discardingPlayer, lastDiscard)
                 and discardingPlayer.playedDangerous):
             player.usedDangerousFrom = discardingPlayer
             if Debug.dangerousGame:
@@ -694,15 +726,32 @@ class ServerTable(Table):
         if msgArgs:
             self.abort(*msgArgs) # pylint: disable=W0142
         player.declaredMahJongg(concealedMelds, withDiscard, player.lastTile, lastMeld)
-        if not player.hand.won:
+        self.server.compute(self.__hand, PlayerSnapshot(player), player.handString()).addCallback(self.__mahJonggEvaluated,
+            player, discardingPlayer, robbedTheKong, concealedMelds, withDiscard, lastMeld).addErrback(
+            self.computeFailed)
+
+    @staticmethod
+    def __hand(snapshot, string):
+        """evaluate the hand of the player. This may take a while.
+        This runs in a thread, so it gets a PlayerSnapshot"""
+        return Hand.cached(snapshot, string)
+
+    def __mahJonggEvaluated(self, hand, player, discardingPlayer, robbedTheKong,
+            concealedMelds, withDiscard, lastMeld):
+        """continue claimMahJongg after the hand is evaluated"""
+        # pylint: disable=R0913
+        # too many arguments
+        if not self.running:
+            return
+        if not hand.won:
             msg = m18nE('%1 claiming MahJongg: This is not a winning hand: %2')
-            self.abort(msg, player.name, player.hand.string)
+            self.abort(msg, player.name, hand.string)
             return
         block = DeferredBlock(self)
         if robbedTheKong:
             block.tellAll(player, Message.RobbedTheKong, tile=withDiscard)
         if (player.lastSource == 'd'
-                and self.game.dangerousFor(discardingPlayer, player.lastTile)
+                and self.game.isDangerousFor(discardingPlayer, player.lastTile)
                 and discardingPlayer.playedDangerous):
             player.usedDangerousFrom = discardingPlayer
             if Debug.dangerousGame:
@@ -713,6 +762,12 @@ class ServerTable(Table):
                      lastMeld=list(lastMeld.pairs), withDiscard=withDiscard)
         block.callback(self.endHand)
 
+    def computeFailed(self, failure):
+        """evaluating a hand failed"""
+        logError(failure.getTraceback())
+        if self.running:
+            self.abort('internal error: %s' % failure.getErrorMessage())
+
     def dealt(self, dummyResults):
         """all tiles are dealt, ask east to discard a tile"""
         if self.running:
@@ -797,7 +852,6 @@ class MJServer(object):
         self.tables = {}
         self.srvUsers = list()
         Players.load()
-        self.checkPings()
 
     def chat(self, chatString):
         """a client sent us a chat message"""
@@ -812,8 +866,9 @@ class MJServer(object):
             self.srvUsers.append(user)
             self.loadSuspendedTables(user)
 
-    def callRemote(self, user, *args, **kwargs):
-        """if we still have a connection, call remote, otherwise clean up"""
+    @staticmethod
+    def checkRemoteArgs(args, kwargs):
+        """only pass what the client can take"""
         legalTypes = (int, long, basestring, float, list, tuple, type(None))
         for arg in args:
             if not isinstance(arg, legalTypes):
@@ -821,6 +876,13 @@ class MJServer(object):
         for keyword, arg in kwargs.items():
             if not isinstance(arg, legalTypes):
                 raise Exception('callRemote got illegal kwarg: %s:%s %s' % (keyword, arg, type(arg)))
+
+    def callRemote(self, user, *args, **kwargs):
+        """if we still have a connection, call remote, otherwise clean up"""
+        self.checkRemoteArgs(args, kwargs)
+        if user.pendingMoves:
+            # they must arrive first
+            self.flushMoves(user)
         if user.mind:
             try:
                 return user.mind.callRemote(*args, **kwargs).addErrback(MJServer.ignoreLostConnection)
@@ -828,15 +890,76 @@ class MJServer(object):
                 user.mind = None
                 self.logout(user)
 
-    def checkPings(self):
-        """are all clients still alive? If not log them out"""
-        for user in self.srvUsers:
-            diff = datetime.datetime.now() - user.lastPing
-            if diff > datetime.timedelta(seconds=20):
-                logDebug('No messages from %s since 20 seconds, clearing connection now' % user.name)
-                user.mind = None
-                self.logout(user)
-        reactor.callLater(10, self.checkPings) # pylint:disable=E1101
+    def sendMove(self, user, aboutName, commandName, **kwargs):
+        """send a move to user and return a Deferred for the answer. If the
+        client can take batches, moves for user are collected until the
+        end of this reactor turn and sent with one call to remote_moves"""
+        if not user.batchMoves:
+            return self.callRemote(user, 'move', aboutName, commandName, **kwargs)
+        self.checkRemoteArgs((aboutName, commandName), kwargs)
+        if not user.mind:
+            return None
+        if not user.pendingMoves:
+            reactor.callLater(0, self.flushMoves, user) # pylint: disable=E1101
+        result = Deferred()
+        user.pendingMoves.append((result, aboutName, commandName, kwargs))
+        return result
+
+    def flushMoves(self, user):
+        """send all collected moves for user"""
+        moves = user.pendingMoves
+        if not moves:
+            return
+        user.pendingMoves = []
+        deferreds = list(x[0] for x in moves)
+        if len(moves) == 1:
+            dummy, aboutName, commandName, kwargs = moves[0]
+            remote = self.callRemote(user, 'move', aboutName, commandName, **kwargs)
+            if remote:
+                remote.addCallback(lambda answer: [(True, answer)])
+        else:
+            remote = self.callRemote(user, 'moves', list(x[1:] for x in moves))
+        if remote is None:
+            failure = Failure(pb.PBConnectionLost('%s has no connection' % user.name))
+            for deferred in deferreds:
+                deferred.errback(failure)
+        else:
+            remote.addCallbacks(self.__movesAnswered, self.__movesFailed,
+                callbackArgs=(deferreds,), errbackArgs=(deferreds,))
+
+    @staticmethod
+    def __movesAnswered(answers, deferreds):
+        """every move gets its own answer or its own failure,
+        see Client.remote_moves"""
+        if answers is None:
+            # lost connection, see ignoreLostConnection
+            answers = [(True, None)] * len(deferreds)
+        for deferred, (success, answer) in zip(deferreds, answers):
+            if success:
+                deferred.callback(answer)
+            else:
+                deferred.errback(Failure(pb.Error(answer)))
+
+    @staticmethod
+    def __movesFailed(failure, deferreds):
+        """the call itself failed, so every move gets the failure"""
+        for deferred in deferreds:
+            deferred.errback(failure)
+
+    @staticmethod
+    def compute(function, *args):
+        """run function in a thread and return a Deferred for its result.
+        Evaluating hands may take long and other tables should not
+        have to wait for that"""
+        return deferToThread(function, *args)
+
+    def idle(self, user):
+        """the idle timer of user expired: he is gone, log him out"""
+        user.idleTimer = None
+        logDebug('No messages from %s since %d seconds, clearing connection now' % (
+            user.name, User.idleTimeout))
+        user.mind = None
+        self.logout(user)
 
     @staticmethod
     def ignoreLostConnection(failure):
@@ -900,6 +1023,15 @@ class MJServer(object):
         assert result
         return result
 
+    def scoreString(self, user, tableid, playerName):
+        """the last score string we sent for playerName at tableid, if we still know it.
+        Only for users sitting at that table"""
+        table = self.tables.get(tableid)
+        if table:
+            if user not in table.users:
+                raise srvError(pb.Error, m18nE('You are not sitting at table <numid>%1</numid>'), tableid)
+            return table.scoreStrings.get(playerName)
+
     def needRulesets(self, rulesetHashes):
         """the client wants those full rulesets"""
         result = []
@@ -986,6 +1118,7 @@ class MJServer(object):
         if user not in self.srvUsers:
             return
         self.srvUsers.remove(user)
+        user.stopIdleTimer()
         for tableid in self.tablesWith(user):
             self.leaveTable(user, tableid, m18nE('Player %1 has logged out'), user.name)
         # wait a moment. We want the leaveTable message to arrive everywhere before
@@ -1049,6 +1182,7 @@ class MJServer(object):
 
 class User(pb.Avatar):
     """the twisted avatar"""
+    idleTimeout = 20 # seconds without any message from the client
     def delete(self):
         """for better garbage collection"""
         pass
@@ -1059,18 +1193,37 @@ class User(pb.Avatar):
         self.dbIdent = None
         self.voiceId = None
         self.maxGameId = None
-        self.lastPing = None
-        self.lastPing = datetime.datetime.now()
-        self.pinged()
+        self.batchMoves = False
+        self.scoreHashes = False
+        self.pendingMoves = [] # (Deferred, aboutName, commandName, kwargs)
+        self.idleTimer = None
 
     def pinged(self):
-        """time of last ping or message from user"""
-        self.lastPing = datetime.datetime.now()
+        """we got a ping or some other message from user. Only quiet
+        users ever reach the end of their idle timer"""
+        if self.idleTimer:
+            self.idleTimer.reset(self.idleTimeout)
+        elif self.server and self in self.server.srvUsers:
+            self.idleTimer = reactor.callLater( # pylint: disable=E1101
+                self.idleTimeout, self.server.idle, self)
+
+    def stopIdleTimer(self):
+        """the user has gone, no need to watch him anymore"""
+        if self.idleTimer:
+            if self.idleTimer.active():
+                self.idleTimer.cancel()
+            self.idleTimer = None
+
+    def perspectiveMessageReceived(self, broker, message, args, kw):
+        """override pb.Avatar: every call from the client proves that it is alive"""
+        self.pinged()
+        return pb.Avatar.perspectiveMessageReceived(self, broker, message, args, kw)
 
     def attached(self, mind):
         """override pb.Avatar.attached"""
         self.mind = mind
         self.server.login(self)
+        self.pinged()
     def detached(self, dummyMind):
         """override pb.Avatar.detached"""
         if Debug.connections:
@@ -1101,6 +1254,15 @@ class User(pb.Avatar):
                             clientVersion or '<4.9.0',
                             '.'.join(serverVersion.split('.')[:2]) + '.*'))
         self.server.sendTables(self)
+    def perspective_batchMoves(self):
+        """the client understands remote_moves"""
+        self.batchMoves = True
+    def perspective_scoreHashes(self):
+        """the client is content with hashes of score strings"""
+        self.scoreHashes = True
+    def perspective_scoreString(self, tableid, playerName):
+        """perspective_* methods are to be called remotely"""
+        return self.server.scoreString(self, tableid, playerName)
     def perspective_ping(self):
         """perspective_* methods are to be called remotely"""
         return self.pinged()
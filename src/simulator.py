@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2012 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+
+
+Play entire games within one process, for measuring AI variants
+with kajonggtest. The game server logic talks directly to four robot
+clients: no sockets, no Perspective Broker, no reactor and no GUI.
+One of the robots plays the AI variant to be tested just like the human
+client in autoPlay mode does, and the result is the same csv row.
+
+Importing this module makes this process a game server.
+"""
+
+import os
+import shutil
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from server import MJServer, ServerTable
+from client import Client
+from game import RemoteGame
+from rule import Ruleset
+from intelligence import AIDefault, findAI
+from query import DBHandle, initDb
+from common import Options
+from util import logWarning
+
+TESTER = 'Tester 1'
+ROBOTS = ['Robot 1', 'Robot 2', 'Robot 3']
+
+class SimulatorClient(Client):
+    """a robot client living in the simulator. Its answers are queued
+    and only given to the table when the simulator gets to them.
+    Without that, a game would be one single recursion."""
+
+    def __init__(self, simulator, name, intelligence=AIDefault):
+        Client.__init__(self, name, intelligence)
+        self.simulator = simulator
+
+    def remote_move(self, playerName, command, *args, **kwargs):
+        """execute the move now but answer later"""
+        answer = Deferred()
+        Client.remote_move(self, playerName, command, *args, **kwargs).addBoth(
+            self.simulator.queueAnswer, answer)
+        return answer
+
+class TesterClient(SimulatorClient):
+    """plays the AI variant to be tested, in place of a human client"""
+
+    @staticmethod
+    def isHumanClient():
+        """we want the same csv tags and hand ids as a human client"""
+        return True
+
+class SimulatorTable(ServerTable):
+    """a table with robot players only"""
+    # pylint: disable=R0913
+    # pylint says too many arguments
+
+    def __init__(self, simulator, ruleset, seed, aiVariant, aiClass, playOpen=False):
+        ServerTable.__init__(self, simulator, None, ruleset, None, playOpen, True, str(seed))
+        self.aiVariant = aiVariant # as given by kajonggtest, for the csv row
+        self.aiClass = aiClass
+        self.serverClient = Client() # the game only holds a weak reference
+
+    def readyForGameStart(self, dummyUser=None):
+        """all players are always ready"""
+        self.game = RemoteGame([TESTER] + ROBOTS, self.ruleset, client=self.serverClient,
+            playOpen=self.playOpen, autoPlay=self.autoPlay, wantedGame=self.wantedGame, shouldSave=True)
+        for player in self.game.players:
+            if player.name == TESTER:
+                remote = TesterClient(self.server, player.name, self.aiClass)
+            else:
+                remote = SimulatorClient(self.server, player.name)
+            remote.table = self
+            self.remotes[player] = remote
+            player.shouldSave = False # the robots use the data base of the server
+        self.proposeGameId(self.calcGameId())
+
+    def collectGameIdAnswers(self, dummyRequests, gameid):
+        """there are no other data bases"""
+        self.game.gameid = gameid
+        self.initGame()
+
+    def assignVoices(self, dummyResults=None):
+        """robots do not talk"""
+        self.startHand()
+
+    def tester(self):
+        """the client playing the tested AI variant"""
+        for player, remote in self.remotes.items():
+            if player.name == TESTER:
+                return remote
+
+class Simulator(MJServer):
+    """a game server for robot tables in this process"""
+
+    def __init__(self, ruleset, playOpen=False):
+        MJServer.__init__(self)
+        self.ruleset = ruleset
+        self.playOpen = playOpen
+        self.answers = deque()
+        self.rows = {}
+
+    @staticmethod
+    def compute(function, *args):
+        """there is no reactor and nobody else to wait"""
+        return maybeDeferred(function, *args)
+
+    def queueAnswer(self, result, answer):
+        """result is what the client answered. Pass it on later"""
+        self.answers.append((answer, result))
+
+    def removeTable(self, table, reason, message=None, *args):
+        """remember the result of a finished game"""
+        if reason == 'gameOver':
+            game = table.tester().game
+            game.rotateWinds() # like the human client does
+            self.rows[table.tableid] = game.csvRow(table.aiVariant)
+        MJServer.removeTable(self, table, reason, message, *args)
+
+    def play(self, seed, aiVariant='Default'):
+        """play one game and return its csv row. None if the
+        game did not end normally"""
+        aiClass = findAI(aiVariant)
+        if not aiClass:
+            raise Exception('intelligence %s is undefined' % aiVariant)
+        table = SimulatorTable(self, self.ruleset, seed, aiVariant, aiClass, self.playOpen)
+        table.readyForGameStart()
+        while self.answers:
+            answer, result = self.answers.popleft()
+            answer.callback(result)
+        result = self.rows.pop(table.tableid, None)
+        if result is None:
+            logWarning('game %s/%s did not end normally' % (aiVariant, seed))
+            if table.tableid in self.tables:
+                self.removeTable(table, 'silent')
+        return result
+
+def findRuleset(name):
+    """returns the ruleset with name, raises Exception if there is none"""
+    import predefined # pylint: disable=W0612
+    for ruleset in Ruleset.availableRulesets():
+        if ruleset.name == name:
+            return ruleset
+    raise Exception('Ruleset %s is unknown' % name)
+
+def initPrivateDb(path):
+    """use a copy of the server data base at path. Returns False if it
+    cannot be opened. A simulator running in parallel with others needs
+    its own data base because sqlite serializes all writers"""
+    source = DBHandle.dbPath()
+    if os.path.exists(source):
+        shutil.copyfile(source, path)
+    Options.dbPath = path
+    return initDb()
@@ -18,6 +18,91 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
+# Tiles as small integers: the tiles of a hand can then be held in a counts
+# vector with one slot per tile id, the string representation is only used
+# at the boundaries. Suit tiles come first, in blocks of 9 per suit, so
+# counts[SUITBASE[suit]:SUITBASE[suit] + 9] are the value counts of one suit.
+# Slots 0..33 are the playing tiles, 34..41 the bonus tiles.
+
+from collections import defaultdict
+
+from common import IntDict
+
+SUITBASE = {'s': 0, 'b': 9, 'c': 18}
+HONORBASE = 27
+BONUSBASE = 34
+TILECOUNT = 42
+
+TILENAMES = tuple(['%s%d' % (suit, value) for suit in 'sbc' for value in range(1, 10)]
+    + ['we', 'ws', 'ww', 'wn', 'db', 'dg', 'dr']
+    + ['fe', 'fs', 'fw', 'fn', 'ye', 'ys', 'yw', 'yn'])
+
+TILEIDS = dict((name, idx) for idx, name in enumerate(TILENAMES))
+TILEIDS.update((name.capitalize(), idx) for idx, name in enumerate(TILENAMES))
+
+def tileId(element):
+    """the tile id of element, ignoring upper/lower case"""
+    return TILEIDS[element]
+
+def tileName(tileIdx, concealed=False):
+    """the element name for a tile id"""
+    result = TILENAMES[tileIdx]
+    if concealed and tileIdx < BONUSBASE:
+        result = result.capitalize()
+    return result
+
+def tileCounts(elements):
+    """a counts vector: how often each tile id appears in elements.
+    Upper/lower case is ignored, hidden tiles (Xy) are not counted"""
+    result = [0] * TILECOUNT
+    for element in elements:
+        if element != 'Xy':
+            result[TILEIDS[element]] += 1
+    return result
+
+def countsToElements(counts, concealed=False):
+    """the sorted element names for a counts vector"""
+    result = []
+    for tileIdx, count in enumerate(counts):
+        if count:
+            result.extend([tileName(tileIdx, concealed)] * count)
+    return result
+
+def suitCounts(counts, suit):
+    """a tuple with the counts of the values 1..9 of suit"""
+    base = SUITBASE[suit]
+    return tuple(counts[base:base + 9])
+
+class TileCounter(IntDict):
+    """an IntDict of element names which also maintains a counts vector,
+    ignoring upper/lower case. Changes propagate into the counts
+    vector of the parent just like into the parent dict"""
+
+    def __init__(self, parent=None):
+        IntDict.__init__(self, parent)
+        self.counts = [0] * TILECOUNT
+
+    def copy(self):
+        """the copy gets its own counts vector"""
+        result = TileCounter(self.parent)
+        for key, value in defaultdict.items(self):
+            defaultdict.__setitem__(result, key, value)
+            result.counts[TILEIDS[key]] += value
+        return result
+
+    def __setitem__(self, key, value):
+        self.counts[TILEIDS[key]] += value - defaultdict.get(self, key, 0)
+        IntDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.counts[TILEIDS[key]] -= defaultdict.get(self, key, 0)
+        IntDict.__delitem__(self, key)
+
+    def clear(self):
+        for key, value in defaultdict.items(self):
+            self.counts[TILEIDS[key]] -= value
+        IntDict.clear(self)
+
 def chiNext(element, offset):
     """the element name of the following value"""
     color, baseValue = element